@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+""" Randomized equivalence check and microbenchmark for the response
+    parser of the AT dongles.
+
+    Compares AtBase.parse_response against the previous line splitting
+    parser, which is kept here as reference. Valid responses are built
+    from random payloads, then randomly corrupted (dropped, swapped or
+    duplicated lines, bad characters, wrong lengths). Both parsers have
+    to return the same data and frame count or raise the same error.
+    The old parser expected 27 characters per line for 29 bit headers
+    (8 header digits and 16 data digits are 24), so those are only
+    checked against the encoded payload. Whitespace, signs and 0x
+    prefixes inside a line are not generated either: int() and fromhex()
+    of the old parser accepted them, the new one rejects them. """
+from random import Random
+from timeit import repeat
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from dongle import NoData, CanError
+from dongle.at_base_dongle import AtBase
+from dongle.fake_dongle import data as FakeData
+
+CASES = 20000
+NUMBER = 20000
+REPEAT = 5
+
+
+def legacy_parse_response(dongle, cmd, ret):
+    """ The parser as it was before the single pass parser """
+    # pylint: disable=protected-access
+    try:
+        data = None
+        data_len = 0
+        last_idx = 0
+        raw = str(ret, 'ascii').split('\r\n')
+
+        for line in raw:
+            if ((dongle._is_extended is False and len(line) != 19)
+                    or (dongle._is_extended is True and len(line) != 27)):
+                raise ValueError
+
+            offset = 8 if dongle._is_extended else 3
+
+            frame_type = int(line[offset:offset+1], 16)
+
+            if frame_type == 0:     # Single frame
+                data_len = int(line[offset+1:offset+2], 16)
+                data = bytes.fromhex(line[offset+2:data_len*2+offset+2])
+                break
+
+            elif frame_type == 1:   # First frame
+                data_len = int(line[offset+1:offset+4], 16)
+                data = bytearray.fromhex(line[offset+4:])
+                last_idx = 0
+
+            elif frame_type == 2:   # Consecutive frame
+                idx = int(line[offset+1:offset+2], 16)
+                if (last_idx + 1) % 0x10 != idx:
+                    raise CanError("Bad frame order: last_idx(%d) idx(%d)" %
+                                   (last_idx, idx))
+
+                frame_len = min(7, data_len - len(data))
+                data.extend(bytearray.fromhex(
+                    line[offset+2:frame_len*2+offset+2]))
+                last_idx = idx
+
+                if data_len == len(data):
+                    break
+
+            else:                   # Unexpected frame
+                raise ValueError
+
+        if not data or data_len == 0:
+            raise NoData('NO DATA')
+
+        if data_len != len(data):
+            raise CanError("Data length mismatch %s: %d vs %d %s" %
+                           (cmd, data_len, len(data), data.hex()))
+
+    except ValueError:
+        raise CanError("Failed Command %s\n%s" % (cmd, ret))
+
+    return data, len(raw)
+
+
+def make_dongle(extended):
+    """ Create an AtBase without serial port """
+    dongle = AtBase.__new__(AtBase)
+    # pylint: disable=protected-access
+    dongle._log = logging.getLogger("EVNotiPi/bench")
+    dongle._is_extended = extended
+    return dongle
+
+
+def encode(payload, canrx, extended, rand):
+    """ Return the lines a dongle prints for payload """
+    header = format(canrx, '08X' if extended else '03X')
+    if len(payload) <= 7:
+        return [header + ('0%X' % len(payload) + payload.hex().upper()).ljust(16, '0')]
+
+    lines = [header + '1%03X' % len(payload) + payload[:6].hex().upper()]
+    idx = 1
+    for pos in range(6, len(payload), 7):
+        chunk = payload[pos:pos+7].hex()
+        chunk = chunk.upper() if rand.random() < 0.5 else chunk
+        lines.append(header + '2%X' % (idx % 0x10) +
+                     chunk.ljust(14, rand.choice('0A')))
+        idx += 1
+    return lines
+
+
+def corrupt(lines, rand):
+    """ Apply a random corruption to the lines of a response """
+    lines = list(lines)
+    kind = rand.randrange(8)
+    line_idx = rand.randrange(len(lines))
+    if kind == 0 and len(lines) > 1:
+        del lines[line_idx]
+    elif kind == 1 and len(lines) > 1:
+        other = rand.randrange(len(lines))
+        lines[line_idx], lines[other] = lines[other], lines[line_idx]
+    elif kind == 2:
+        lines.insert(line_idx, lines[line_idx])
+    elif kind == 3:
+        line = lines[line_idx]
+        pos = rand.randrange(len(line))
+        lines[line_idx] = line[:pos] + rand.choice('G.Z') + line[pos + 1:]
+    elif kind == 4:
+        lines[line_idx] = lines[line_idx][:-1]
+    elif kind == 5:
+        line = lines[line_idx]
+        pos = rand.randrange(len(line))
+        lines[line_idx] = line[:pos] + rand.choice('0123456789ABCDEF') + line[pos + 1:]
+    elif kind == 6:
+        lines.append(lines[-1])
+    return lines
+
+
+def outcome(func, *args):
+    """ Return the result of func or the class of its exception """
+    try:
+        return func(*args)
+    except (NoData, CanError) as err:
+        return type(err)
+
+
+def check(rand):
+    """ Compare both parsers on random responses """
+    compared = 0
+    for _ in range(CASES):
+        extended = rand.random() < 0.3
+        dongle = make_dongle(extended)
+        canrx = rand.randrange(0x20000000 if extended else 0x800)
+        payload = bytes(rand.randrange(256) for _ in range(rand.choice((
+            rand.randrange(1, 8), rand.randrange(7, 100)))))
+        lines = encode(payload, canrx, extended, rand)
+        if extended:
+            ret = bytearray('\r\n'.join(lines), 'ascii')
+            if dongle.parse_response('cmd', ret) != (payload, len(lines)):
+                raise AssertionError('%r: %r' % (ret, payload))
+            continue
+        if rand.random() < 0.5:
+            lines = corrupt(lines, rand)
+        ret = bytearray('\r\n'.join(lines), 'ascii')
+
+        try:
+            expected = outcome(legacy_parse_response, dongle, 'cmd', bytes(ret))
+        except TypeError:
+            # The old parser did not handle consecutive frames without
+            # first frame, skip those
+            continue
+        result = outcome(dongle.parse_response, 'cmd', ret)
+        if result != expected:
+            raise AssertionError('%r: %r != %r' % (ret, result, expected))
+        compared += 1
+    return compared
+
+
+def main():
+    """ Check the parsers for equal results and time them on the FakeDongle responses """
+    compared = check(Random(0))
+    print("%d random responses parsed identically" % compared)
+
+    dongle = make_dongle(False)
+    rand = Random(1)
+    for car_type in ('IONIQ_BEV', 'IONIQ_FL_EV'):
+        for cantx, responses in FakeData[car_type].items():
+            for cmd, payload in responses.items():
+                ret = bytearray('\r\n'.join(encode(payload, cantx + 8, False, rand)), 'ascii')
+                if dongle.parse_response(cmd, ret)[0] != payload:
+                    raise AssertionError('%s: %s' % (cmd.hex(), ret))
+                before = min(repeat(lambda r=ret: legacy_parse_response(dongle, cmd, bytes(r)),
+                                    number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+                after = min(repeat(lambda r=ret: dongle.parse_response(cmd, r),
+                                   number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+                print("%-12s %-7s lines %2d  before %6.2f us  after %6.2f us  speedup %.2fx" %
+                      (car_type, cmd.hex(), ret.count(b'\r\n') + 1, before, after,
+                       before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+""" Microbenchmark for the Zoe broadcast frame decoding.
+
+    Compares the compiled signal table decoders against the previous
+    if/elif chain, which is kept here as reference. Both are fed the
+    same random frames of the decoded messages. """
+from random import Random
+from timeit import repeat
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from car.broadcast_decoder import BroadcastDecoder
+from car.car import ifbu
+from car.zoe import Messages
+
+FRAMES = 1000
+REPEAT = 5
+
+
+def legacy_decode(can_id, msg, data):
+    """ The reader loop body as it was before the signal table """
+    if can_id == 0x42e:
+        data.update({
+            'SOC_DISPLAY':                  (ifbu(msg[0:2]) >> 3 & 0x1fff) * 0.02,
+            })
+        data.update({
+            'dcBatteryVoltage':             (ifbu(msg[3:5]) >> 5 & 0x03ff) * 0.5,
+            'batteryMaxTemperature':        (ifbu(msg[5:7]) >> 5 & 0x007f) - 40,
+            'batteryMinTemperature':        (ifbu(msg[5:7]) >> 5 & 0x007f) - 40,
+            })
+    elif can_id == 0x5d7:
+        data.update({
+            'odo':                          (ifbu(msg[2:6]) >> 4) * 0.01,
+            })
+    elif can_id == 0x638:
+        data.update({
+            'dcBatteryPower':               msg[0] - 80.0,
+            })
+    elif can_id == 0x654:
+        cpc = msg[0] >> 5 & 0x1
+        data.update({
+            'normalChargePort':             int(cpc == 1),
+            })
+    elif can_id == 0x656:
+        data.update({
+            'externalTemperature':          msg[6] - 40.0,
+            })
+    elif can_id == 0x658:
+        data.update({
+            'charging':                     msg[5] >> 5 & 0x1,
+            'soh':                          msg[4] & 0x7f,
+            })
+    elif can_id == 0x6f8:
+        data.update({
+            'auxBatteryVoltage':            msg[2] * 0.0625,
+            })
+
+
+def main():
+    """ Check both decoders for equal results, then time them """
+    decoder = BroadcastDecoder(Messages)
+    rand = Random(0)
+    frames = [(rand.choice(list(decoder.decoders)),
+               memoryview(bytes(rand.randrange(256) for _ in range(8))))
+              for _ in range(FRAMES)]
+
+    for can_id, msg in frames:
+        expected = {}
+        decoded = {}
+        legacy_decode(can_id, msg, expected)
+        decoder.decode(can_id, msg, decoded)
+        if expected != decoded:
+            raise AssertionError('%x: %r != %r' % (can_id, decoded, expected))
+
+    def run_legacy():
+        data = {}
+        for can_id, msg in frames:
+            legacy_decode(can_id, msg, data)
+
+    def run_compiled(decoders=decoder.decoders):
+        data = {}
+        for can_id, msg in frames:
+            decode = decoders.get(can_id)
+            if decode is not None:
+                decode(msg, data)
+
+    before = min(repeat(run_legacy, number=100, repeat=REPEAT)) / (100 * FRAMES) * 1e9
+    after = min(repeat(run_compiled, number=100, repeat=REPEAT)) / (100 * FRAMES) * 1e9
+    print("before %6.0f ns/frame  after %6.0f ns/frame  speedup %.2fx" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+""" Microbenchmark for IsoTpDecoder.get_data using the FakeDongle responses.
+
+    Compares the compiled per-command decoders against the previous
+    interpreting decoder loop, which is kept here as reference. The
+    reference runs with patterned fields (i.e. cellVoltage%02d), the
+    compiled decoders with their vectors (cellVoltages). Intervals are
+    removed so both poll every command in each cycle and only the
+    decoding differs. """
+from copy import deepcopy
+from timeit import repeat
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from car import ioniq_bev, kona_ev
+from car.isotp_decoder import IsoTpDecoder
+from dongle import NoData
+from dongle.fake_dongle import FakeDongle
+
+CARS = (
+    ('IONIQ_BEV', ioniq_bev.Fields),
+    ('IONIQ_FL_EV', kona_ev.Fields),
+)
+
+NUMBER = 2000
+REPEAT = 5
+
+
+def vector_patterns(fields):
+    """ Return the patterned name and first idx of every vector """
+    patterns = {}
+    for cmd_data in fields:
+        for field in cmd_data['fields']:
+            if field.get('array'):
+                pattern, idx = patterns.get(field['array'], (field['name'], field['idx']))
+                patterns[field['array']] = (pattern, min(idx, field['idx']))
+    return patterns
+
+
+def poll_all(fields):
+    """ Remove the intervals so every group is polled in each cycle """
+    fields = deepcopy(fields)
+    for cmd_data in fields:
+        cmd_data.pop('interval', None)
+    return fields
+
+
+def expand_vectors(data, patterns):
+    """ Turn vectors into single values named like patterned fields """
+    expanded = {}
+    for name, value in data.items():
+        if name in patterns:
+            pattern, start = patterns[name]
+            for idx, item in enumerate(value, start):
+                expanded[pattern % idx] = item
+        else:
+            expanded[name] = value
+    return expanded
+
+
+def legacy_get_data(decoder):
+    """ The decoder loop as it was before compiling the decoders """
+    # pylint: disable=protected-access
+    data = {}
+    for cmd_data in decoder._fields:
+        try:
+            if cmd_data['computed']:
+                for field in cmd_data['fields']:
+                    data[field['name']] = field['lambda'](data)
+            else:
+                raw = decoder._dongle.send_command_ex(cmd_data['cmd'],
+                                                      canrx=cmd_data['canrx'],
+                                                      cantx=cmd_data['cantx'])
+                raw_fields = cmd_data['struct'].unpack(raw)
+
+                for field in cmd_data['fields']:
+                    name = field['name']
+                    fmt_idx = field['fmt_idx']
+                    fmt_len = field['fmt_len']
+
+                    if 'lambda' in field:
+                        value = field['lambda'](raw_fields[fmt_idx:fmt_idx+fmt_len])
+                    else:
+                        value = raw_fields[fmt_idx]
+
+                    data[name] = value * field['scale'] + field['offset']
+        except NoData:
+            if not cmd_data.get('optional', False):
+                raise
+
+    return data
+
+
+def bench(func):
+    """ Return the best time per call in microseconds """
+    return min(repeat(func, number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+
+
+def main():
+    """ Run the benchmark for all cars with FakeDongle data """
+    for car_type, fields in CARS:
+        dongle = FakeDongle({'car_type': car_type})
+        legacy = IsoTpDecoder(dongle, deepcopy(fields))
+        decoder = IsoTpDecoder(dongle, poll_all(fields), arrays=True)
+
+        expected = legacy_get_data(legacy)
+        decoded = expand_vectors(decoder.get_data(), vector_patterns(fields))
+        if any(decoded.get(name) != value for name, value in expected.items()):
+            raise AssertionError('%s: compiled decoder output differs' % car_type)
+
+        before = bench(lambda d=legacy: legacy_get_data(d))
+        after = bench(decoder.get_data)
+        print("%-12s keys %3d -> %3d  before %7.2f us  after %7.2f us  speedup %.2fx" %
+              (car_type, len(legacy_get_data(legacy)), len(decoder.get_data()),
+               before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+""" Compare the per-cycle data dict with the Sample record.
+
+    Reads FakeDongle data of a car into both and reports the time of one
+    cycle (initialize, read the car, add the GPS fields) and the memory
+    held by samples kept around, as evnotify.py does between
+    transmissions. The dict is filled like poll_data did before Sample,
+    merging the decoder's own dict. """
+from argparse import ArgumentParser
+from time import perf_counter
+from timeit import repeat
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from car import ioniq_bev, kona_ev, zoe_ze50
+from car.car import SampleDefaults
+from dongle.fake_dongle import FakeDongle
+
+CARS = {
+    'IONIQ_BEV': ioniq_bev.IoniqBev,
+    'IONIQ_FL_EV': kona_ev.KonaEv,
+    'ZOE_ZE50': zoe_ze50.ZoeZe50,
+}
+FIX = {'fix_mode': 3, 'latitude': 52.5, 'longitude': 13.4, 'speed': 0.0,
+       'gdop': 1.2, 'pdop': 1.1, 'hdop': 0.9, 'vdop': 0.8, 'tdop': 0.7,
+       'altitude': 34.0, 'gps_device': '/dev/ttyAMA0'}
+REPEAT = 5
+
+
+class Watchdog:
+    """ Car is always available """
+
+    @staticmethod
+    def is_car_available():
+        """ Always True """
+        return True
+
+
+def build_dict(car):
+    """ Build one cycle's data the way poll_data did before Sample """
+    data = dict(SampleDefaults)
+    data['timestamp'] = perf_counter()
+    data.update(car.get_base_data())
+    # pylint: disable=protected-access
+    data.update(car._isotp.get_data())
+    data.update(FIX)
+    return data
+
+
+def build_sample(car):
+    """ Build one cycle's data with the car's sample template """
+    # pylint: disable=protected-access
+    data = car._new_sample(perf_counter())
+    car.read_dongle(data)
+    data.update(FIX)
+    return data
+
+
+def measure(build, count):
+    """ Return the best µs per call of build and bytes per kept result """
+    elapsed = min(repeat(build, number=count, repeat=REPEAT))
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build() for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return elapsed / count * 1e6, size / count
+
+
+def main():
+    """ Run the comparison for all cars """
+    parser = ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--count', type=int, default=10000)
+    args = parser.parse_args()
+
+    for car_type, car_class in CARS.items():
+        car = car_class({'interval': 1}, FakeDongle({'car_type': car_type}), Watchdog(), None)
+        for name, build in (('dict', lambda: build_dict(car)),
+                            ('Sample', lambda: build_sample(car))):
+            usec, size = measure(build, args.count)
+            print("%-12s %-7s %6.2f µs/cycle  %6.0f bytes/sample" % (car_type, name, usec, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" Benchmark the serial dongle modules against the pty emulator.
+
+    For every car with FakeDongle data and every dongle module, runs the
+    car's IsoTpDecoder against bench/elm_emulator.py and reports the
+    commands per second on the serial line and the cycle latency of
+    get_data. The first cycles let the dongle learn response counts and
+    timeouts and are not measured. """
+from argparse import ArgumentParser
+from copy import deepcopy
+from statistics import mean, quantiles
+from time import perf_counter
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+import dongle
+from car import ioniq_bev, kona_ev, zoe_ze50
+from car.isotp_decoder import IsoTpDecoder
+from elm_emulator import ElmEmulator
+
+CARS = (
+    ('IONIQ_BEV', ioniq_bev.Fields, 'CAN_11_500', {}),
+    ('IONIQ_FL_EV', kona_ev.Fields, 'CAN_11_500', {}),
+    ('ZOE_ZE50', zoe_ze50.Fields, 'CAN_29_500',
+     {'multi_did': (zoe_ze50.LBC_TX, zoe_ze50.EVC_TX, zoe_ze50.BCB_TX)}),
+)
+DONGLES = ('ELM327', 'PiOBD2Hat', 'STN11xx')
+
+
+def run(args, car_type, fields, protocol, decoder_args, dongle_type):
+    """ Return commands per second and the cycle latencies in ms """
+    emulator = ElmEmulator(car_type, dongle_type, args.baudrate or None, args.latency,
+                           args.frame_gap, args.timeout)
+    config = {'port': emulator.port, 'speed': args.baudrate or 115200,
+              'speed_file': os.path.join(args.state_dir, 'dongle_speed')}
+    if args.max_speed:
+        config['max_speed'] = args.max_speed
+    try:
+        dev = dongle.load(dongle_type)(config)
+        dev.set_protocol(protocol)
+        decoder = IsoTpDecoder(dev, deepcopy(fields), **decoder_args)
+        for _ in range(args.warmup):
+            decoder.get_data()
+
+        commands = emulator.requests + emulator.at_commands
+        latencies = []
+        start = perf_counter()
+        for _ in range(args.cycles):
+            cycle_start = perf_counter()
+            decoder.get_data()
+            latencies.append((perf_counter() - cycle_start) * 1000)
+        elapsed = perf_counter() - start
+        commands = emulator.requests + emulator.at_commands - commands
+    finally:
+        emulator.close()
+
+    return commands / elapsed, latencies
+
+
+def main():
+    """ Run all cars with all dongles and print the results """
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--baudrate', type=int, default=38400,
+                        help='Serial speed to emulate, 0 for unlimited')
+    parser.add_argument('--max-speed', type=int,
+                        help='Let the dongles negotiate up to this speed')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='ECU response latency in seconds')
+    parser.add_argument('--frame-gap', type=float, default=0.001,
+                        help='Time between the frames of a response in seconds')
+    parser.add_argument('--timeout', type=float,
+                        help='Fixed adapter timeout in seconds instead of ATST')
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--cars', nargs='*', default=[car[0] for car in CARS])
+    parser.add_argument('--dongles', nargs='*', default=DONGLES)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as args.state_dir:
+        for car_type, fields, protocol, decoder_args in CARS:
+            if car_type not in args.cars:
+                continue
+            for dongle_type in args.dongles:
+                rate, latencies = run(args, car_type, fields, protocol,
+                                      decoder_args, dongle_type)
+                print("%-12s %-10s %6.1f commands/s  cycle mean %7.1f ms  "
+                      "p95 %7.1f ms  max %7.1f ms" %
+                      (car_type, dongle_type, rate, mean(latencies),
+                       quantiles(latencies, n=20, method='inclusive')[-1], max(latencies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+""" Benchmark SocketCan against the ECU simulator on a vcan interface.
+
+    Starts bench/can_ecu_simulator.py as separate process and runs the
+    car's IsoTpDecoder cycles with kernel ISO-TP sockets from the pool
+    (isotp), with a new socket per command as before the pool
+    (isotp-unpooled) and with the userspace ISO-TP engine (canraw).
+    For the Zoe Q210 the broadcast frames are read and decoded instead
+    (broadcast). Reports the cycle time, the CPU time of this process
+    and, if strace is available, the syscalls.
+
+    Requires a vcan interface, the can-isotp kernel module for the isotp
+    modes:
+        ip link add dev vcan0 type vcan && ip link set vcan0 up """
+from argparse import ArgumentParser
+from copy import deepcopy
+from shutil import which
+from socket import PF_CAN, SOCK_RAW, CAN_RAW
+from statistics import mean, quantiles
+from subprocess import Popen, run
+from tempfile import NamedTemporaryFile
+from time import perf_counter, sleep
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from car import ioniq_bev, kona_ev, zoe, zoe_ze50
+from car.broadcast_decoder import BroadcastDecoder
+from car.isotp_decoder import IsoTpDecoder
+from dongle.socket_can import SocketCan, CanSocket, IsoTpEngine
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'can_ecu_simulator.py')
+
+CARS = {
+    'IONIQ_BEV': (ioniq_bev.Fields, 'CAN_11_500', {}),
+    'IONIQ_FL_EV': (kona_ev.Fields, 'CAN_11_500', {}),
+    'ZOE_ZE50': (zoe_ze50.Fields, 'CAN_29_500',
+                 {'multi_did': (zoe_ze50.LBC_TX, zoe_ze50.EVC_TX, zoe_ze50.BCB_TX)}),
+}
+MODES = ('isotp', 'isotp-unpooled', 'canraw')
+
+
+def cpu_time():
+    """ Return the user and system time of this process """
+    times = os.times()
+    return times.user + times.system
+
+
+def p95(values):
+    """ Return the 95th percentile, the largest value of short series """
+    if len(values) < 2:
+        return max(values)
+    return quantiles(values, n=20, method='inclusive')[-1]
+
+
+def open_dongle(args, mode):
+    """ Return a SocketCan using the implementation of mode or None if
+        the kernel does not support it """
+    dongle = SocketCan({'port': args.port, 'speed': 500000})
+    # pylint: disable=protected-access
+    if mode.startswith('isotp'):
+        if dongle._isotp_engine is not None:
+            return None
+        if mode == 'isotp-unpooled':
+            send = dongle.send_command_ex
+
+            def send_unpooled(cmd, cantx, canrx):
+                try:
+                    return send(cmd, cantx, canrx)
+                finally:
+                    # Only the ECU's own socket, the other ECUs are
+                    # queried concurrently
+                    for key in list(dongle._isotp_socks):
+                        if key[:2] == (canrx, cantx):
+                            dongle._drop_isotp_socket(key)
+
+            dongle.send_command_ex = send_unpooled
+    elif mode == 'canraw':
+        if dongle._isotp_engine is None:
+            sock = CanSocket(PF_CAN, SOCK_RAW, CAN_RAW)
+            sock.bind((args.port,))
+            dongle._isotp_engine = IsoTpEngine(sock)
+        dongle.send_command_ex = dongle.send_command_ex_canraw
+    return dongle
+
+
+def run_cycles(args, mode, count):
+    """ Run count decoder cycles after warming up, return the
+        cycle times in ms and the CPU time in ms per cycle """
+    fields, protocol, decoder_args = CARS[args.car]
+    dongle = open_dongle(args, mode)
+    if dongle is None:
+        return None, None
+    dongle.set_protocol(protocol)
+    decoder = IsoTpDecoder(dongle, deepcopy(fields), **decoder_args)
+    for _ in range(args.warmup):
+        decoder.get_data()
+
+    latencies = []
+    cpu_start = cpu_time()
+    for _ in range(count):
+        start = perf_counter()
+        decoder.get_data()
+        latencies.append((perf_counter() - start) * 1000)
+    cpu = (cpu_time() - cpu_start) * 1000 / max(1, count)
+    dongle.close_sockets()
+    return latencies, cpu
+
+
+def run_broadcast(args, seconds):
+    """ Read and decode the Zoe broadcast frames for seconds, return
+        the decoded frames per second and the CPU load in % """
+    dongle = open_dongle(args, 'broadcast')
+    decoder = BroadcastDecoder(zoe.Messages)
+    dongle.set_protocol('CAN_11_500')
+    dongle.set_raw_filters_ex(decoder.get_filters())
+    decoders = decoder.decoders
+    data = {}
+    frames = 0
+    cpu_start = cpu_time()
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        for can_id, msg in dongle.read_raw_frames(0.1):
+            decode = decoders.get(can_id)
+            if decode is not None:
+                decode(msg, data)
+                frames += 1
+    elapsed = perf_counter() - start
+    dongle.close_sockets()
+    return frames / max(elapsed, 1e-9), (cpu_time() - cpu_start) / max(elapsed, 1e-9) * 100
+
+
+def count_syscalls(args, mode, count):
+    """ Run this benchmark under strace, return the total syscall count """
+    with NamedTemporaryFile('r') as out:
+        run(['strace', '-f', '-c', '-o', out.name, sys.executable, __file__,
+             '--port', args.port, '--car', args.car, '--count', str(count),
+             '--warmup', str(args.warmup), '--mode', mode, '--no-simulator'],
+            check=True, capture_output=True)
+        for line in out:
+            if line.strip().endswith('total'):
+                return int(line.split()[3])
+    return 0
+
+
+def start_simulator(args):
+    """ Start the ECU simulator process for the car """
+    cmd = [sys.executable, SIMULATOR, '--port', args.port, '--car', args.car,
+           '--latency', str(args.latency), '--jitter', str(args.jitter),
+           '--loss', str(args.loss), '--noise', str(args.noise)]
+    if args.car == 'ZOE_Q210':
+        cmd.append('--broadcast')
+    simulator = Popen(cmd)
+    # Let it bind its socket
+    sleep(0.5)
+    return simulator
+
+
+def main():
+    """ Run the benchmark """
+    parser = ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--port', default='vcan0')
+    parser.add_argument('--car', default='IONIQ_BEV', choices=sorted(CARS) + ['ZOE_Q210'])
+    parser.add_argument('--count', type=int, default=50,
+                        help='Cycles to measure, seconds for the broadcast mode')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='ECU response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.002)
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='Probability of losing a frame sent by the ECUs')
+    parser.add_argument('--noise', type=int, default=0,
+                        help='Unrelated frames per second on the bus')
+    parser.add_argument('--mode', choices=MODES + ('broadcast',))
+    parser.add_argument('--no-simulator', action='store_true',
+                        help='Use an already running simulator')
+    args = parser.parse_args()
+    if args.count < 1:
+        parser.error("--count must be at least 1")
+
+    simulator = None if args.no_simulator else start_simulator(args)
+    try:
+        if args.mode:
+            modes = (args.mode,)
+        elif args.car == 'ZOE_Q210':
+            modes = ('broadcast',)
+        else:
+            modes = MODES
+
+        for mode in modes:
+            if mode == 'broadcast':
+                rate, load = run_broadcast(args, args.count)
+                line = "%-14s %7.1f frames/s  %5.1f %% CPU" % (mode, rate, load)
+                unit, per = 's', args.count
+            else:
+                latencies, cpu = run_cycles(args, mode, args.count)
+                if latencies is None:
+                    print("%-14s not supported by the kernel" % mode)
+                    continue
+                line = ("%-14s cycle mean %7.2f ms  p95 %7.2f ms  CPU %6.2f ms/cycle" %
+                        (mode, mean(latencies), p95(latencies), cpu))
+                unit, per = 'cycle', args.count
+            if not args.mode and which('strace') and per > 1:
+                # Subtract startup overhead, measured with a single cycle
+                # (second) as the measurement needs at least one
+                syscalls = (count_syscalls(args, mode, args.count) -
+                            count_syscalls(args, mode, 1))
+                line += "  %7.1f syscalls/%s" % (syscalls / (per - 1), unit)
+            print(line)
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+            simulator.wait()
+
+
+if __name__ == '__main__':
+    main()
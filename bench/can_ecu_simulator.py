@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+""" ECU simulator on a (v)can interface for the SocketCAN benchmarks.
+
+    Acts as the ECUs of a car with FakeDongle data: single frame requests
+    are answered with the FakeDongle payloads via ISO-TP on a raw socket,
+    honouring flow control, so both the kernel ISO-TP and the userspace
+    path of SocketCan can talk to it. Optionally sends the Zoe broadcast
+    messages at their cycle times and unrelated frames as bus load.
+
+    latency     seconds until an ECU starts to answer, plus up to jitter
+    loss        probability of dropping each frame the ECUs send
+    broadcast   send the broadcast messages of car/zoe.py
+    noise       unrelated frames per second
+
+    Requires a vcan interface:
+        ip link add dev vcan0 type vcan && ip link set vcan0 up
+        bench/can_ecu_simulator.py --port vcan0 --car IONIQ_BEV """
+from argparse import ArgumentParser
+from heapq import heappush, heappop
+from random import Random
+from select import poll, POLLIN
+from socket import socket, PF_CAN, SOCK_RAW, CAN_RAW, CAN_EFF_FLAG
+from time import monotonic, sleep
+import errno
+import os
+import signal
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from car.zoe import Messages as ZoeMessages
+from dongle.fake_dongle import FakeDongle, data as FakeData
+from dongle.socket_can import CANFMT, CANHDR
+
+PADDING = 0xaa
+# Approximate cycle times of the Zoe broadcast messages in seconds
+BROADCAST_PERIODS = {
+    0x42e: 0.1,
+    0x5d7: 0.1,
+    0x638: 0.1,
+    0x654: 0.5,
+    0x656: 0.5,
+    0x658: 0.5,
+    0x6f8: 0.1,
+}
+# Ids used for the bus load, none of them is decoded or requested
+NOISE_IDS = range(0x100, 0x200)
+# Bus load is sent in bursts at this interval
+NOISE_TICK = 0.01
+
+
+def response_id(cantx):
+    """ Return the id an ECU answers requests to cantx with """
+    if cantx > 0x7ff:
+        # 29 bit: target and source address swapped
+        return cantx & 0xffff0000 | (cantx & 0xff) << 8 | cantx >> 8 & 0xff
+    return cantx + 8
+
+
+def raw_id(can_id):
+    """ Return can_id with the EFF flag set for 29 bit ids """
+    return can_id | CAN_EFF_FLAG if can_id > 0x7ff else can_id
+
+
+class EcuSimulator:
+    """ Simulate the ECUs of car_type on a bound raw CAN socket """
+
+    def __init__(self, sock, car_type, latency=0.0, jitter=0.0, loss=0.0,
+                 broadcast=False, noise=0, seed=0):
+        self._sock = sock
+        self._latency = latency
+        self._jitter = jitter
+        self._loss = loss
+        self._noise = noise
+        self._rand = Random(seed)
+        self._ecus = FakeDongle({'car_type': car_type}) if car_type in FakeData else None
+        # Request id -> (tester's cantx, response id)
+        self._requests = {}
+        if self._ecus:
+            for cantx in FakeData[car_type]:
+                self._requests[raw_id(cantx)] = (cantx, raw_id(response_id(cantx)))
+        # Consecutive frames waiting for flow control by request id
+        self._waiting = {}
+        # Frames to send: (time, sequence, can_id, data)
+        self._queue = []
+        self._seq = 0
+        self.sent = 0
+        self.dropped = 0
+        self.received = 0
+
+        now = monotonic()
+        if broadcast:
+            for message in ZoeMessages:
+                self._schedule(now, message['can_id'], None)
+        if noise:
+            self._schedule(now, None, None)
+
+    def _schedule(self, when, can_id, data):
+        """ Queue a frame, data None for cyclic broadcast, can_id None
+            for a burst of bus load """
+        self._seq += 1
+        heappush(self._queue, (when, self._seq, can_id, data))
+
+    def _send(self, can_id, data):
+        """ Send one frame, possibly dropping it """
+        if self._loss and self._rand.random() < self._loss:
+            self.dropped += 1
+            return
+        frame = CANFMT.pack(can_id, 8, bytes(data).ljust(8, bytes([PADDING])))
+        while True:
+            try:
+                self._sock.send(frame)
+                break
+            except OSError as err:
+                if err.errno != errno.ENOBUFS:
+                    raise
+                # TX queue of the interface is full
+                sleep(0.001)
+        self.sent += 1
+
+    def _answer(self, request_id, msg):
+        """ Handle a frame sent to an ECU """
+        cantx, rx_id = self._requests[request_id]
+        frame_type = msg[0] & 0xf0
+        if frame_type == 0x00:      # Single frame request
+            cmd = bytes(msg[1:1 + (msg[0] & 0x0f)])
+            try:
+                payload = self._ecus.send_command_ex(cmd, cantx, response_id(cantx))
+            except (KeyError, ValueError):
+                return              # Unknown requests are not answered
+
+            when = monotonic() + self._latency + self._rand.random() * self._jitter
+            if len(payload) <= 7:
+                self._schedule(when, rx_id, bytes([len(payload)]) + payload)
+                return
+            self._schedule(when, rx_id, bytes([0x10 | len(payload) >> 8, len(payload) & 0xff]) +
+                           payload[:6])
+            self._waiting[request_id] = [bytes([0x20 | idx & 0xf]) + payload[pos:pos + 7]
+                                         for idx, pos in enumerate(range(6, len(payload), 7), 1)]
+
+        elif frame_type == 0x30 and request_id in self._waiting:   # Flow control
+            if msg[0] & 0x0f:
+                return              # Wait or overflow
+            block_size = msg[1]
+            if msg[2] <= 0x7f:
+                st_min = msg[2] / 1000
+            elif 0xf1 <= msg[2] <= 0xf9:
+                st_min = (msg[2] - 0xf0) / 10000
+            else:
+                st_min = 0.127      # Reserved values mean the maximum
+            frames = self._waiting.pop(request_id)
+            if block_size and len(frames) > block_size:
+                self._waiting[request_id] = frames[block_size:]
+                frames = frames[:block_size]
+            when = monotonic()
+            for frame in frames:
+                self._schedule(when, rx_id, frame)
+                when += st_min
+
+    def _send_due(self, now):
+        """ Send all frames that are due, return the time of the next one """
+        while self._queue and self._queue[0][0] <= now:
+            when, _, can_id, data = heappop(self._queue)
+            if can_id is None:
+                # Bus load burst
+                count = max(1, round(self._noise * NOISE_TICK))
+                for _ in range(count):
+                    self._send(self._rand.choice(NOISE_IDS), self._rand.randbytes(8))
+                self._schedule(when + NOISE_TICK, None, None)
+            elif data is None:
+                self._send(can_id, self._rand.randbytes(8))
+                self._schedule(when + BROADCAST_PERIODS.get(can_id, 0.1), can_id, None)
+            else:
+                self._send(can_id, data)
+        return self._queue[0][0] if self._queue else None
+
+    def run(self, duration=None):
+        """ Serve until duration seconds passed or forever """
+        buf = bytearray(CANFMT.size)
+        view = memoryview(buf)
+        poller = poll()
+        poller.register(self._sock, POLLIN)
+        end = None if duration is None else monotonic() + duration
+        while True:
+            now = monotonic()
+            if end is not None and now >= end:
+                return
+            next_send = self._send_due(now)
+            timeout = None
+            for limit in (next_send, end):
+                if limit is not None:
+                    timeout = limit - now if timeout is None else min(timeout, limit - now)
+            if not poller.poll(None if timeout is None else max(0, timeout * 1000)):
+                continue
+            self._sock.recv_into(buf)
+            self.received += 1
+            can_id, length = CANHDR.unpack_from(buf)
+            if can_id in self._requests and length:
+                self._answer(can_id, view[8:8 + length])
+
+
+def main():
+    """ Run the simulator until terminated """
+    parser = ArgumentParser(description=__doc__.split('\n', maxsplit=1)[0])
+    parser.add_argument('--port', default='vcan0')
+    parser.add_argument('--car', default='IONIQ_BEV',
+                        choices=sorted(FakeData) + ['ZOE_Q210'])
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--broadcast', action='store_true')
+    parser.add_argument('--noise', type=int, default=0)
+    parser.add_argument('--duration', type=float)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sock = socket(PF_CAN, SOCK_RAW, CAN_RAW)
+    sock.bind((args.port,))
+    simulator = EcuSimulator(sock, args.car, args.latency, args.jitter, args.loss,
+                             args.broadcast, args.noise, args.seed)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        simulator.run(args.duration)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        print("received %d frames, sent %d, dropped %d" %
+              (simulator.received, simulator.sent, simulator.dropped), file=sys.stderr)
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
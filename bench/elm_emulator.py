@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+""" ELM327, PiOBD2Hat and STN11xx emulator serving a pseudo terminal.
+
+    Answers the AT commands the dongle modules send and replays the ECU
+    responses of dongle/fake_dongle.py, formatted like the real adapter
+    prints them (headers on, CAN auto formatting). Timing is modelled by:
+
+    baudrate    pace both directions like a serial line of that speed
+                (None: as fast as the pty goes). ATBRD/STBR change it.
+    latency     seconds until the ECU sends its first frame
+    frame_gap   seconds between the frames of one response
+    timeout     seconds the adapter waits for further frames after the
+                last one, unless the request carried the number of
+                frames (None: ATST on ELM327, t: on STN, 0.1 s on the
+                PiOBD2Hat)
+
+    Run it directly to serve a car for manual tests:
+        bench/elm_emulator.py IONIQ_BEV --baudrate 38400 """
+from argparse import ArgumentParser
+from select import select
+from threading import Thread
+from time import monotonic, sleep
+import os
+import sys
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# pylint: disable=wrong-import-position
+from dongle.fake_dongle import FakeDongle
+
+ELM_IDENT = 'ELM327 v1.5'
+HAT_IDENT = 'DIAMEX PI-OBD v1.6'
+STN_IDENT = 'STN1110 v4.6.0'
+# ATST counts in steps of 4.096 ms, ATZ sets 0x32
+ST_STEP = 0.004096
+ST_DEFAULT = 0x32
+HAT_TIMEOUT = 0.1
+# Time the adapter waits for the carriage return after switching speed
+SPEED_SWITCH_WAIT = 0.075
+
+
+def response_id(cantx):
+    """ Return the id an ECU answers requests to cantx with """
+    if cantx > 0x7ff:
+        # 29 bit: target and source address swapped
+        return cantx & 0xffff0000 | (cantx & 0xff) << 8 | cantx >> 8 & 0xff
+    return cantx + 8
+
+
+def isotp_frames(payload):
+    """ Split payload into the 8 byte ISO-TP frames """
+    if len(payload) <= 7:
+        return [(bytes([len(payload)]) + payload).ljust(8, b'\0')]
+
+    frames = [bytes([0x10 | len(payload) >> 8, len(payload) & 0xff]) + payload[:6]]
+    for idx, pos in enumerate(range(6, len(payload), 7), 1):
+        frames.append((bytes([0x20 | idx & 0xf]) + payload[pos:pos+7]).ljust(8, b'\0'))
+    return frames
+
+
+class ElmEmulator:
+    """ Serve one car on a pseudo terminal, port holds its name """
+
+    def __init__(self, car_type, flavour='ELM327', baudrate=None,
+                 latency=0.0, frame_gap=0.0, timeout=None):
+        if flavour not in ('ELM327', 'PiOBD2Hat', 'STN11xx'):
+            raise ValueError('Unsupported flavour %s' % flavour)
+        self._ecus = FakeDongle({'car_type': car_type})
+        self._flavour = flavour
+        self._baudrate = baudrate
+        self._latency = latency
+        self._frame_gap = frame_gap
+        self._timeout = timeout
+        self._buffer = b''
+        self._reset()
+
+        # Number of requests to ECUs and of AT/ST commands received
+        self.requests = 0
+        self.at_commands = 0
+
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        Thread(target=self._serve, daemon=True).start()
+
+    def _reset(self):
+        """ Settings after power on or ATZ """
+        self._echo = True
+        self._linefeed = self._flavour != 'ELM327'
+        self._spaces = True
+        self._headers = False
+        self._extended = False
+        self._header = 0x7df
+        self._st = ST_DEFAULT
+
+    def close(self):
+        """ Close the pseudo terminal """
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _transfer(self, length):
+        """ Wait for length bytes to pass the serial line """
+        if self._baudrate:
+            sleep(length * 10 / self._baudrate)
+
+    def _write(self, text):
+        """ Send text to the host at the current speed """
+        data = bytes(text, 'ascii')
+        self._transfer(len(data))
+        os.write(self._master, data)
+
+    def _read_line(self, timeout=None):
+        """ Return the next line from the host or None after timeout """
+        deadline = None if timeout is None else monotonic() + timeout
+        while b'\r' not in self._buffer:
+            wait = None if deadline is None else max(0, deadline - monotonic())
+            if not select([self._master], [], [], wait)[0]:
+                return None
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return None
+            if not data:
+                return None
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\r', 1)
+        self._transfer(len(line) + 1)
+        return str(line, 'ascii', 'replace').strip()
+
+    def _serve(self):
+        """ Answer the host until the pty is closed """
+        while True:
+            line = self._read_line()
+            if line is None:
+                return
+            if not line:
+                continue
+            if self._echo:
+                self._write(line + '\r')
+            self._answer(line)
+
+    def _eol(self):
+        """ Return the line end selected with ATL """
+        return '\r\n' if self._linefeed else '\r'
+
+    def _reply(self, *lines):
+        """ Send response lines followed by the prompt """
+        eol = self._eol()
+        for line in lines:
+            self._write(line + eol)
+        self._write(eol + '>')
+
+    def _format_frame(self, can_id, frame):
+        """ Format a received frame like the adapter prints it """
+        sep = ' ' if self._spaces else ''
+        text = sep.join('%02X' % byte for byte in frame)
+        if self._headers:
+            text = format(can_id, '08X' if self._extended else '03X') + sep + text
+        return text
+
+    def _adapter_timeout(self, timeout_ms=None):
+        """ Return the time to wait for further frames """
+        if self._timeout is not None:
+            return self._timeout
+        if timeout_ms is not None:
+            return timeout_ms / 1000
+        if self._flavour == 'PiOBD2Hat':
+            return HAT_TIMEOUT
+        return self._st * ST_STEP
+
+    def _request(self, cmd, cantx, count=None, timeout_ms=None):
+        """ Send cmd to the ECU cantx and print its response """
+        self.requests += 1
+        try:
+            payload = self._ecus.send_command_ex(bytes.fromhex(cmd), cantx, response_id(cantx))
+        except (KeyError, ValueError):
+            sleep(self._adapter_timeout(timeout_ms))
+            self._reply('NO DATA')
+            return
+
+        sleep(self._latency)
+        frames = isotp_frames(payload)
+        eol = self._eol()
+        for idx, frame in enumerate(frames[:count]):
+            if idx and self._frame_gap:
+                sleep(self._frame_gap)
+            self._write(self._format_frame(response_id(cantx), frame) + eol)
+        if count is None or count > len(frames):
+            sleep(self._adapter_timeout(timeout_ms))
+        self._write(eol + '>')
+
+    def _switch_speed(self, speed, ident):
+        """ Speed switch handshake of ATBRD and STBR """
+        self._write('OK' + self._eol())
+        old_speed = self._baudrate
+        if self._baudrate:
+            self._baudrate = speed
+        self._write(ident + '\r')
+        if self._read_line(SPEED_SWITCH_WAIT) is None:
+            self._baudrate = old_speed
+            self._write(self._eol() + '>')
+        else:
+            self._write('>')
+
+    def _answer(self, line):
+        """ Execute one command """
+        cmd = line.upper().replace(' ', '')
+        if not cmd.startswith(('AT', 'ST')):
+            try:
+                int(cmd, 16)
+            except ValueError:
+                self._reply('?')
+                return
+            count = None
+            if len(cmd) % 2 and self._flavour != 'PiOBD2Hat':
+                count = int(cmd[-1], 16)
+                cmd = cmd[:-1]
+            self._request(cmd, self._header, count)
+            return
+
+        self.at_commands += 1
+        ident = {'ELM327': ELM_IDENT, 'PiOBD2Hat': HAT_IDENT, 'STN11xx': ELM_IDENT}[self._flavour]
+        if cmd in ('ATZ', 'ATRST', 'ATWS'):
+            self._reset()
+            self._reply(ident)
+        elif cmd == 'ATI':
+            self._reply(ident)
+        elif cmd == 'STI' and self._flavour == 'STN11xx':
+            self._reply(STN_IDENT)
+        elif cmd == 'ATRV':
+            self._reply('12.6V')
+        elif cmd == 'AT!10' and self._flavour == 'PiOBD2Hat':
+            self._reply('18.16V')
+        elif cmd[:3] in ('ATE', 'ATL', 'ATS', 'ATH') and cmd[3:] in ('0', '1'):
+            setattr(self, {'E': '_echo', 'L': '_linefeed', 'S': '_spaces',
+                           'H': '_headers'}[cmd[2]], cmd[3] == '1')
+            self._reply('OK')
+        elif cmd.startswith('ATOHS') and cmd[5:] in ('0', '1'):
+            self._spaces = cmd[5] == '1'
+            self._reply('OK')
+        elif cmd.startswith('ATST') and len(cmd) == 6:
+            self._st = int(cmd[4:], 16) or ST_DEFAULT
+            self._reply('OK')
+        elif cmd in ('ATSP6', 'ATSP7', 'ATP6', 'ATP7'):
+            self._extended = cmd[-1] == '7'
+            self._reply('OK' if self._flavour != 'PiOBD2Hat' else
+                        '7 = ISO 15765-4, CAN (29/500)' if self._extended else
+                        '6 = ISO 15765-4, CAN (11/500)')
+        elif cmd.startswith(('ATSH', 'ATCT')):
+            self._header = int(cmd[4:], 16)
+            self._reply('OK')
+        elif cmd.startswith('ATBRD') and self._flavour != 'PiOBD2Hat':
+            self._switch_speed(round(4000000 / int(cmd[5:], 16)), ident)
+        elif cmd.startswith('STBR') and self._flavour == 'STN11xx':
+            self._switch_speed(int(cmd[4:]), ident)
+        elif cmd.startswith('STPX') and self._flavour == 'STN11xx':
+            params = dict(param.split(':', 1) for param in cmd[4:].split(','))
+            self._request(params['D'], int(params['H'], 16),
+                          int(params['R']) if 'R' in params else None,
+                          int(params['T']) if 'T' in params else None)
+        elif cmd.startswith(('ATCF', 'ATCM', 'ATCR', 'ATAT', 'ATFE', 'ATONI', 'ATCV')):
+            self._reply('OK')
+        else:
+            self._reply('?')
+
+
+def main():
+    """ Serve a car until interrupted """
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('car_type')
+    parser.add_argument('--flavour', default='ELM327',
+                        choices=('ELM327', 'PiOBD2Hat', 'STN11xx'))
+    parser.add_argument('--baudrate', type=int)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--frame-gap', type=float, default=0.0)
+    parser.add_argument('--timeout', type=float)
+    args = parser.parse_args()
+
+    emulator = ElmEmulator(args.car_type, args.flavour, args.baudrate,
+                           args.latency, args.frame_gap, args.timeout)
+    print("Serving %s as %s on %s" % (args.car_type, args.flavour, emulator.port))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    main()
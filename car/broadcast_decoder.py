@@ -0,0 +1,114 @@
+""" Generic decoder for cars broadcasting their data in cyclic CAN frames """
+from socket import CAN_EFF_FLAG, CAN_EFF_MASK, CAN_SFF_MASK
+import logging
+from .codegen import build_function, const
+
+
+def signal_bytes(signal):
+    """ Return the byte positions covered by a signal and the shift of
+        its least significant bit in the last one (big endian) or
+        the first one (little endian). Start bits follow the DBC
+        conventions: the most significant bit for big endian (Motorola)
+        signals, the least significant bit for little endian (Intel). """
+    start = signal['start']
+    length = signal['length']
+    if signal.get('byteorder', 'big') == 'big':
+        # Position in the frame counted from the MSB of the first byte
+        msb = start // 8 * 8 + 7 - start % 8
+        lsb = msb + length - 1
+        return list(range(msb // 8, lsb // 8 + 1)), 7 - lsb % 8
+
+    return list(range(start // 8, (start + length - 1) // 8 + 1)), start % 8
+
+
+def compile_message_decoder(can_id, signals):
+    """ Build a function decode(msg, data) which extracts all signals of
+        one message with precomputed byte positions, shifts and masks and
+        stores the scaled values in data. Frames too short for the
+        signals are ignored. """
+    namespace = {}
+    lines = []
+    min_len = 0
+    for signal in signals:
+        if 'name' not in signal:
+            raise ValueError('Name missing in signal of %x' % can_id)
+        if signal['length'] < 1 or signal['length'] > 64:
+            raise ValueError('Unsupported length of signal %s' % signal['name'])
+
+        positions, shift = signal_bytes(signal)
+        if positions[-1] > 7:
+            raise ValueError('Signal %s exceeds the frame' % signal['name'])
+        min_len = max(min_len, positions[-1] + 1)
+
+        if signal.get('byteorder', 'big') != 'big':
+            positions = positions[::-1]
+        width = len(positions)
+        value = ' | '.join('msg[%d] << %d' % (pos, (width - idx - 1) * 8) if idx < width - 1
+                           else 'msg[%d]' % pos
+                           for idx, pos in enumerate(positions))
+        if width > 1:
+            value = '(%s)' % value
+        if shift:
+            value = '(%s >> %d)' % (value, shift)
+        if signal['length'] < width * 8 - shift:
+            value = '(%s & %d)' % (value, (1 << signal['length']) - 1)
+        if signal.get('signed', False):
+            # Two's complement: flip the sign bit and subtract its weight
+            sign = 1 << (signal['length'] - 1)
+            value = '((%s ^ %d) - %d)' % (value, sign, sign)
+
+        scale = signal.get('scale', 1)
+        offset = signal.get('offset', 0)
+        if scale != 1:
+            value = '%s * %s' % (value, const(scale, namespace))
+        if offset != 0:
+            value = '%s + %s' % (value, const(offset, namespace))
+
+        lines.append('data[%r] = %s' % (signal['name'], value))
+
+    lines.insert(0, 'if len(msg) < %d: return' % min_len)
+    return build_function('decode_%x' % can_id, 'msg, data', lines, namespace)
+
+
+class BroadcastDecoder:
+    """ Decoder for broadcast frames described by a table of messages,
+        each with its can_id, signals and optionally extended (29 bit id,
+        implied for ids above 0x7ff). A signal has a name, start bit,
+        length, and optionally scale, offset, signed and byteorder
+        ('big' or 'little'). Every message is compiled into one decoder
+        function, looked up by can_id in decoders. signal_names holds the
+        names each message sets. """
+
+    def __init__(self, messages):
+        self._log = logging.getLogger("EVNotiPi/Broadcast-Decoder")
+        self._messages = messages
+        self.decoders = {}
+        self.signal_names = {}
+        self._extended = set()
+        for message in messages:
+            can_id = message['can_id']
+            if can_id in self.decoders:
+                raise ValueError('Message %x defined twice' % can_id)
+            if message.get('extended', False) or can_id > CAN_SFF_MASK:
+                self._extended.add(can_id)
+            self.decoders[can_id] = compile_message_decoder(can_id, message['signals'])
+            self.signal_names[can_id] = tuple(signal['name'] for signal in message['signals'])
+            self._log.debug("Compiled decoder for %x with %d signals",
+                            can_id, len(message['signals']))
+
+    def decode(self, can_id, msg, data):
+        """ Decode one frame into data, unknown frames are ignored """
+        decoder = self.decoders.get(can_id)
+        if decoder is not None:
+            decoder(msg, data)
+
+    def get_filters(self):
+        """ Return raw socket filters passing only the decoded messages """
+        filters = []
+        for can_id in self.decoders:
+            if can_id in self._extended:
+                filters.append({'id': can_id | CAN_EFF_FLAG,
+                                'mask': CAN_EFF_FLAG | CAN_EFF_MASK})
+            else:
+                filters.append({'id': can_id, 'mask': CAN_EFF_FLAG | CAN_SFF_MASK})
+        return filters
@@ -3,6 +3,40 @@ from time import time, sleep
 from threading import Thread
 import logging
 from dongle import NoData, CanError
+from .sample import Sample, SampleSchema
+
+# Fields every sample is initialized with; saves all those checks later
+SampleDefaults = {
+    'timestamp':    None,
+    # Base:
+    'SOC_BMS':      None,
+    'SOC_DISPLAY':  None,
+    # Extended:
+    'auxBatteryVoltage':        None,
+    'batteryInletTemperature':  None,
+    'batteryMaxTemperature':    None,
+    'batteryMinTemperature':    None,
+    'cumulativeEnergyCharged':  None,
+    'cumulativeEnergyDischarged':   None,
+    'charging':                 None,
+    'normalChargePort':         None,
+    'rapidChargePort':          None,
+    'dcBatteryCurrent':         None,
+    'dcBatteryPower':           None,
+    'dcBatteryVoltage':         None,
+    'soh':                      None,
+    'externalTemperature':      None,
+    'odo':                      None,
+    # Location:
+    'latitude':     None,
+    'longitude':    None,
+    'speed':        None,
+    'fix_mode':     0,
+}
+
+# Fields poll_data adds after reading the car
+PollFields = ('gdop', 'pdop', 'hdop', 'vdop', 'tdop', 'altitude', 'gps_device',
+              'obdVoltage', 'startupThreshold', 'shutdownThreshold', 'emergencyThreshold')
 
 
 def ifbu(in_bytes):
@@ -45,9 +79,35 @@ class Car:
         self._running = False
         self.last_data = 0
         self._data_callbacks = []
+        self._schema = SampleSchema()
+        self._template = None
+        self.extend_schema(SampleDefaults, PollFields)
+
+    def extend_schema(self, *names):
+        """ Add field names to the schema of the samples. Subclasses
+            add the fields read_dongle sets, other fields still work
+            but are stored less compactly. """
+        for part in names:
+            self._schema = self._schema.extend(part)
+        self._template = Sample(self._schema, SampleDefaults)
+
+    def _new_sample(self, now):
+        """ Return an initialized sample for a new polling cycle """
+        data = self._template.copy()
+        data['timestamp'] = now
+        return data
+
+    def _drop_polled(self, data):
+        """ Return a sample for a failed cycle, keeping the timestamp
+            and base data of data but none of the values read from the car """
+        sample = self._new_sample(data['timestamp'])
+        for name in self.get_base_data():
+            if name in data:
+                sample[name] = data[name]
+        return sample
 
     def read_dongle(self, data):
-        """ Get data from CAN bus and put it into "data" dictionary """
+        """ Get data from CAN bus and put it into the "data" sample """
         raise NotImplementedError()
 
     def start(self):
@@ -66,34 +126,7 @@ class Car:
         while self._running:
             now = time()
 
-            # initialize data with required fields; saves all those checks later
-            data = {
-                'timestamp':    now,
-                # Base:
-                'SOC_BMS':      None,
-                'SOC_DISPLAY':  None,
-                # Extended:
-                'auxBatteryVoltage':        None,
-                'batteryInletTemperature':  None,
-                'batteryMaxTemperature':    None,
-                'batteryMinTemperature':    None,
-                'cumulativeEnergyCharged':  None,
-                'cumulativeEnergyDischarged':   None,
-                'charging':                 None,
-                'normalChargePort':         None,
-                'rapidChargePort':          None,
-                'dcBatteryCurrent':         None,
-                'dcBatteryPower':           None,
-                'dcBatteryVoltage':         None,
-                'soh':                      None,
-                'externalTemperature':      None,
-                'odo':                      None,
-                # Location:
-                'latitude':     None,
-                'longitude':    None,
-                'speed':        None,
-                'fix_mode':     0,
-            }
+            data = self._new_sample(now)
             if not self._skip_polling or self._watchdog.is_car_available():
                 if self._skip_polling:
                     self._log.info("Resume polling.")
@@ -103,11 +136,15 @@ class Car:
                     self.last_data = now
                 except CanError as err:
                     self._log.warning(err)
+                    data = self._drop_polled(data)
                 except NoData:
+                    data = self._drop_polled(data)
                     self._log.info("NO DATA")
                     if not self._watchdog.is_car_available():
                         self._log.info("Car off detected. Stop polling until car on.")
                         self._skip_polling = True
+                        if hasattr(self._dongle, 'suspend_cyclic'):
+                            self._dongle.suspend_cyclic()
                     sleep(1)
 
             fix = self._gps.fix()
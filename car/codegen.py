@@ -0,0 +1,18 @@
+""" Helpers for the decoders compiling their tables into functions """
+
+
+def const(value, namespace):
+    """ Return source for a constant; plain numbers are inlined,
+        everything else is passed in through the namespace """
+    if type(value) in (int, float):
+        return repr(value)
+    name = '_c%d' % len(namespace)
+    namespace[name] = value
+    return name
+
+
+def build_function(name, args, lines, namespace):
+    """ Compile a function from source lines """
+    src = 'def %s(%s):\n    %s\n' % (name, args, '\n    '.join(lines or ['pass']))
+    exec(compile(src, '<decoder %s>' % name, 'exec'), namespace)
+    return namespace[name]
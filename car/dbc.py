@@ -0,0 +1,122 @@
+""" Loader for the messages and signals of DBC files """
+from importlib.util import MAGIC_NUMBER
+import logging
+import marshal
+import os
+import re
+
+Log = logging.getLogger("EVNotiPi/DBC")
+
+# BO_ <id> <name>: <dlc> <sender>
+MESSAGE_RE = re.compile(r'^BO_\s+(\d+)\s+(\w+)\s*:')
+# SG_ <name> [M|m<n>] : <start>|<length>@<byteorder><sign> (<scale>,<offset>) ...
+SIGNAL_RE = re.compile(r'^SG_\s+(\w+)\s*(M|m\d+)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*'
+                       r'\(([^,]+),([^)]+)\)')
+
+DBC_EFF_FLAG = 0x80000000
+# Part of the cache key, increment when the parsed table changes
+CACHE_VERSION = 2
+
+
+def _number(text):
+    """ Parse a DBC number, keep integers as int """
+    value = float(text)
+    if value.is_integer() and not any(c in text for c in '.eE'):
+        return int(value)
+    return value
+
+
+def parse_dbc(lines, signals=None):
+    """ Parse the lines of a DBC file into a table of messages as used by
+        BroadcastDecoder. signals maps the DBC signal names to the names
+        used in the data, or to a list of names to fill several keys from
+        one signal; only those signals, and only messages with at least
+        one of them, are returned. Messages with extended (29 bit) ids,
+        marked by bit 31 of the DBC id, get 'extended' set. Without signals all signals
+        keep their DBC names. Multiplexed signals are not supported and
+        skipped. """
+    messages = []
+    message = None
+    for line in lines:
+        line = line.strip()
+        match = MESSAGE_RE.match(line)
+        if match:
+            can_id = int(match.group(1))
+            message = {'can_id': can_id & ~DBC_EFF_FLAG, 'signals': []}
+            if can_id & DBC_EFF_FLAG:
+                message['extended'] = True
+            messages.append(message)
+            continue
+
+        match = SIGNAL_RE.match(line)
+        if not match:
+            if line and not line.startswith('SG_'):
+                message = None
+            elif line:
+                Log.warning("Can not parse signal: %s", line)
+            continue
+        if message is None:
+            continue
+
+        dbc_name, mux, start, length, byteorder, sign, scale, offset = match.groups()
+        if signals is not None and dbc_name not in signals:
+            continue
+        if mux and mux != 'M':
+            Log.warning("Skipping multiplexed signal %s", dbc_name)
+            continue
+
+        signal = {
+            'start': int(start),
+            'length': int(length),
+        }
+        if byteorder == '1':
+            signal['byteorder'] = 'little'
+        if sign == '-':
+            signal['signed'] = True
+        scale = _number(scale)
+        offset = _number(offset)
+        if scale != 1:
+            signal['scale'] = scale
+        if offset != 0:
+            signal['offset'] = offset
+
+        names = signals[dbc_name] if signals is not None else dbc_name
+        if isinstance(names, str):
+            names = (names,)
+        for name in names:
+            message['signals'].append(dict(signal, name=name))
+
+    return [message for message in messages if message['signals']]
+
+
+def load_dbc(path, signals=None):
+    """ Return the table of messages of a DBC file, see parse_dbc.
+        The table is cached next to the DBC file, the cache is valid
+        for the same python version, DBC file and signal selection. """
+    stat = os.stat(path)
+    key = (MAGIC_NUMBER, CACHE_VERSION, stat.st_mtime_ns, stat.st_size,
+           tuple((dbc_name, names if isinstance(names, str) else tuple(names))
+                 for dbc_name, names in sorted(signals.items()))
+           if signals is not None else None)
+    cache_path = path + '.cache'
+
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_key, messages = marshal.load(cache_file)
+        if cached_key == key:
+            Log.debug("Using cached %s", cache_path)
+            return messages
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    with open(path, encoding='latin-1') as dbc_file:
+        messages = parse_dbc(dbc_file, signals)
+    Log.info("Loaded %d messages from %s", len(messages), path)
+
+    try:
+        with open(cache_path, 'wb') as cache_file:
+            marshal.dump((key, messages), cache_file)
+    except OSError as err:
+        Log.warning("Can not write %s: %s", cache_path, err)
+
+    return messages
@@ -22,7 +22,8 @@ Fields = (
          {'name': 'dcBatteryVoltage', 'width': 2, 'scale': .1},
          {'name': 'batteryMaxTemperature', 'width': 1, 'signed': True},
          {'name': 'batteryMinTemperature', 'width': 1, 'signed': True},
-         {'name': 'cellTemp%02d', 'idx': 1, 'cnt': 5, 'width': 1, 'signed': True},
+         {'name': 'cellTemp%02d', 'idx': 1, 'cnt': 5, 'width': 1, 'signed': True,
+          'array': 'cellTemps'},
          {'padding': 1},
          {'name': 'batteryInletTemperature', 'width': 1, 'signed': True},
          {'padding': 4},
@@ -41,31 +42,35 @@ Fields = (
          # Len: 56
      )
      },
-    {'cmd': b2102, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2102, 'canrx': 0x7ec, 'cantx': 0x7e4, 'interval': 10,
      'fields': (
          {'padding': 6},
-         {'name': 'cellVoltage%02d', 'idx': 1, 'cnt': 32, 'width': 1, 'scale': .02},
+         {'name': 'cellVoltage%02d', 'idx': 1, 'cnt': 32, 'width': 1, 'scale': .02,
+          'array': 'cellVoltages'},
          # Len: 38
      )
      },
-    {'cmd': b2103, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2103, 'canrx': 0x7ec, 'cantx': 0x7e4, 'interval': 10,
      'fields': (
          {'padding': 6},
-         {'name': 'cellVoltage%02d', 'idx': 33, 'cnt': 32, 'width': 1, 'scale': .02},
+         {'name': 'cellVoltage%02d', 'idx': 33, 'cnt': 32, 'width': 1, 'scale': .02,
+          'array': 'cellVoltages'},
          # Len: 38
      )
      },
-    {'cmd': b2104, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b2104, 'canrx': 0x7ec, 'cantx': 0x7e4, 'interval': 10,
      'fields': (
          {'padding': 6},
-         {'name': 'cellVoltage%02d', 'idx': 65, 'cnt': 32, 'width': 1, 'scale': .02},
+         {'name': 'cellVoltage%02d', 'idx': 65, 'cnt': 32, 'width': 1, 'scale': .02,
+          'array': 'cellVoltages'},
          # Len: 38
      )
      },
     {'cmd': b2105, 'canrx': 0x7ec, 'cantx': 0x7e4,
      'fields': (
          {'padding': 11},
-         {'name': 'cellTemp%02d', 'idx': 6, 'cnt': 7, 'width': 1, 'signed': True},
+         {'name': 'cellTemp%02d', 'idx': 6, 'cnt': 7, 'width': 1, 'signed': True,
+          'array': 'cellTemps'},
          {'padding': 9},
          {'name': 'soh', 'width': 2, 'scale': .1},
          {'padding': 4},
@@ -74,7 +79,7 @@ Fields = (
          # Len: 45
      )
      },
-    {'cmd': b2180, 'canrx': 0x7ee, 'cantx': 0x7e6,
+    {'cmd': b2180, 'canrx': 0x7ee, 'cantx': 0x7e6, 'interval': 60,
      'fields': (
          {'padding': 14},
          {'name': 'externalTemperature', 'width': 1, 'scale': .5, 'offset': -40},
@@ -83,6 +88,7 @@ Fields = (
      )
      },
     {'cmd': b22b002, 'canrx': 0x7ce, 'cantx': 0x7c6, 'optional': True,
+     'interval': 60,
      'fields': (
          {'padding': 9},
          {'name': 'odo', 'width': 3},
@@ -111,15 +117,17 @@ class IoniqBev(Car):
     def __init__(self, config, dongle, watchdog, gps):
         Car.__init__(self, config, dongle, watchdog, gps)
         self._dongle.set_protocol('CAN_11_500')
-        self._isotp = IsoTpDecoder(self._dongle, Fields)
+        self._isotp = IsoTpDecoder(self._dongle, Fields,
+                                   arrays=config.get('cell_arrays', False))
+        self.extend_schema(self.get_base_data(), self._isotp.field_names())
 
     def read_dongle(self, data):
         """ Fetch data from CAN-bus and decode it.
-            "data" needs to be a dictionary that will
+            "data" needs to be a dict like sample that will
             be modified with decoded data """
 
         data.update(self.get_base_data())
-        data.update(self._isotp.get_data())
+        self._isotp.get_data(data)
 
     def get_base_data(self):
         return {
@@ -1,7 +1,13 @@
 """ Generic decoder for ISO-TP based cars """
+from array import array
+from collections import deque
+from threading import Thread
+from time import monotonic
 import logging
 import struct
-from dongle import NoData
+import sys
+from dongle import NoData, CanError
+from .codegen import build_function, const
 
 FormatMap = {
     0: {'f': 'x'},
@@ -12,24 +18,234 @@ FormatMap = {
     8: {'f': 'l'},
 }
 
+# Backoff of failing optional commands in seconds, doubled on every
+# failure up to the maximum which bounds the rate of re-probing.
+BACKOFF_BASE = 5
+BACKOFF_MAX = 120
+
+# Maximum number of DIDs packed into one ReadDataByIdentifier request.
+# Three DIDs still fit into a single CAN frame.
+MULTI_DID_MAX = 3
+
+# Type codes used for array valued patterned fields
+ArrayMap = {
+    1: 'b',
+    2: 'h',
+    4: 'i',
+    8: 'q',
+}
+
 
 def is_power_of_two(number):
     """ Check of argument has power of two """
     return (number & (number-1) == 0) and number != 0
 
 
+class ScaledVector:
+    """ Compact vector of raw integer values sharing one scale and offset,
+        i.e. the cell voltages of a battery. Statistics are calculated on
+        the raw values and scaled once. """
+    __slots__ = ('raw', 'scale', 'offset')
+
+    def __init__(self, raw, scale=1, offset=0):
+        self.raw = raw
+        self.scale = scale
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [value * self.scale + self.offset for value in self.raw[idx]]
+        return self.raw[idx] * self.scale + self.offset
+
+    def __iter__(self):
+        scale = self.scale
+        offset = self.offset
+        return (value * scale + offset for value in self.raw)
+
+    def __repr__(self):
+        return 'ScaledVector(%r)' % self.tolist()
+
+    def tolist(self):
+        """ Return the scaled values as list """
+        return list(self)
+
+    def min(self):
+        """ Smallest scaled value """
+        if self.scale < 0:
+            return max(self.raw) * self.scale + self.offset
+        return min(self.raw) * self.scale + self.offset
+
+    def max(self):
+        """ Largest scaled value """
+        if self.scale < 0:
+            return min(self.raw) * self.scale + self.offset
+        return max(self.raw) * self.scale + self.offset
+
+    def mean(self):
+        """ Mean of the scaled values """
+        return sum(self.raw) / len(self.raw) * self.scale + self.offset
+
+    def spread(self):
+        """ Difference between the largest and smallest value """
+        return (max(self.raw) - min(self.raw)) * abs(self.scale)
+
+
+def compile_command_decoder(cmd_struct, fields, segments=()):
+    """ Build a function decode(raw, data) which unpacks the response
+        of one command and stores the scaled values in data. Scale and
+        offset are only applied where they differ from 1 and 0 and
+        lambdas are only called where they are defined. Segments of
+        array valued fields are copied into their vector buffers as
+        raw bytes. """
+    namespace = {'_unpack': cmd_struct.unpack}
+    lines = ['v = _unpack(raw)']
+    for seg in segments:
+        buf = const(seg['vector']['buf'], namespace)
+        lines.append('%s[%d:%d] = raw[%d:%d]' % (buf, seg['dst'], seg['dst'] + seg['len'],
+                                                seg['src'], seg['src'] + seg['len']))
+        lines.append('%s.discard(%d)' % (const(seg['vector']['pending'], namespace),
+                                         seg['dst']))
+    for field in fields:
+        fmt_idx = field['fmt_idx']
+        if 'lambda' in field:
+            value = '%s(v[%d:%d])' % (const(field['lambda'], namespace),
+                                      fmt_idx, fmt_idx + field['fmt_len'])
+        else:
+            value = 'v[%d]' % fmt_idx
+
+        if field['scale'] != 1:
+            value = '%s * %s' % (value, const(field['scale'], namespace))
+        if field['offset'] != 0:
+            value = '%s + %s' % (value, const(field['offset'], namespace))
+
+        lines.append('data[%r] = %s' % (field['name'], value))
+
+    return build_function('decode', 'raw, data', lines, namespace)
+
+
+def compile_computed_decoder(fields):
+    """ Build a function decode(data) which executes the lambdas
+        of a computed "command" in order """
+    namespace = {}
+    lines = ['data[%r] = %s(data)' % (field['name'], const(field['lambda'], namespace))
+             for field in fields]
+
+    return build_function('compute', 'data', lines, namespace)
+
+
 class IsoTpDecoder:
-    """ Generic decoder for ISO-TP based cars """
+    """ Generic decoder for ISO-TP based cars.
+        Command groups with an 'interval' (seconds) are polled at most that
+        often. Due slow groups are polled round robin, at most slow_per_cycle
+        of them per call of get_data. In between, their last values are
+        carried forward. Optional commands that return no data are skipped
+        with exponential backoff; the current backoff is put into the
+        sample as 'optionalBackoff'. Groups sending the same command to
+        the same ECU share one request per cycle. If arrays is set,
+        patterned fields naming a vector in 'array' are decoded into one
+        ScaledVector of that name instead of a key per element. For ECUs
+        listed in multi_did (by cantx) ReadDataByIdentifier requests
+        (22 DID) are packed into requests with up to MULTI_DID_MAX DIDs.
+        If the dongle can handle concurrent requests (concurrent_ecus is
+        set), requests to different ECUs are sent in parallel while the
+        requests to each ECU stay serialised. Otherwise the requests are
+        sent grouped by ECU to save header switches of AT dongles
+        (header_switches counts them), decoding keeps the field order.
+        If the dongle can send requests cyclically (register_cyclic), the
+        requests of ECUs whose requests and responses all fit into single
+        frames are registered with it, each at the interval of its group. """
 
-    def __init__(self, dongle, fields):
+    def __init__(self, dongle, fields, slow_per_cycle=1, multi_did=(), arrays=False):
         self._log = logging.getLogger("EVNotiPi/ISO-TP-Decoder")
         self._dongle = dongle
         self._fields = fields
+        self._arrays = arrays
+        self._vectors = {}
+        self._slow = deque()
+        self._slow_per_cycle = slow_per_cycle
+        self._has_optional = False
+        self._multi_did = set(multi_did)
+        # ECUs that answered a multi DID request, ECUs to be probed with
+        # single requests and ECUs that answered those after a multi DID
+        # request got no data
+        self._multi_did_confirmed = set()
+        self._multi_did_probe = set()
+        self._multi_did_suspect = set()
+        self._concurrent = getattr(dongle, 'concurrent_ecus', False)
+        self._last_ecu = None
+        self._cycle_switches = None
 
         self.preprocess_fields()
 
+    def _vector_bases(self):
+        """ Return the smallest idx of every vector, it becomes the
+            first element """
+        bases = {}
+        for cmd_data in self._fields:
+            for field in cmd_data['fields']:
+                if field.get('array'):
+                    idx = field.get('idx', 0)
+                    bases[field['array']] = min(bases.get(field['array'], idx), idx)
+        return bases
+
+    def _add_vector_segment(self, field, src, base, interval):
+        """ Register a segment of an array valued field. All fields with
+            the same vector name are collected into one vector, which must
+            not mix groups with different intervals. """
+        width = field['width']
+        if width not in ArrayMap:
+            raise ValueError('Unsupported field length for array field')
+        if 'lambda' in field:
+            raise ValueError('Lambda not allowed in array field')
+
+        typecode = ArrayMap[width]
+        if not field.get('signed', False):
+            typecode = typecode.upper()
+
+        scale = field.get('scale', 1)
+        offset = field.get('offset', 0)
+        start = field.get('idx', 0) - base
+        cnt = field.get('cnt', 1)
+
+        vector = self._vectors.setdefault(field['array'], {
+            'typecode': typecode,
+            'width': width,
+            'scale': scale,
+            'offset': offset,
+            'interval': interval,
+            'buf': bytearray(),
+            'pending': set(),
+        })
+
+        if ((vector['typecode'], vector['scale'], vector['offset'], vector['interval']) !=
+                (typecode, scale, offset, interval)):
+            raise ValueError('Array field %s defined inconsistently' % field['array'])
+
+        dst = start * width
+        length = cnt * width
+        if len(vector['buf']) < dst + length:
+            vector['buf'].extend(bytes(dst + length - len(vector['buf'])))
+        vector['pending'].add(dst)
+
+        return {'vector': vector, 'src': src, 'dst': dst, 'len': length}
+
+    def _publish_vectors(self, data):
+        """ Put a copy of every completely received vector into data """
+        for name, vector in self._vectors.items():
+            if vector['pending']:
+                continue
+            # Buffers hold the raw big endian bytes, convert in one go
+            values = array(vector['typecode'], vector['buf'])
+            if vector['width'] > 1 and sys.byteorder == 'little':
+                values.byteswap()
+            data[name] = ScaledVector(values, vector['scale'], vector['offset'])
+
     def preprocess_fields(self):
         """ Preprocess field structure, creating format strings for unpack etc.,"""
+        bases = self._vector_bases() if self._arrays else {}
         for cmd_data in self._fields:
             fmt = ">"
             fmt_idx = 0
@@ -37,11 +253,31 @@ class IsoTpDecoder:
             # make sure 'computed' is set so we don't need to check for it
             # in the decoder. Checking is slow.
             cmd_data['computed'] = cmd_data.get('computed', False)
+            cmd_data['interval'] = cmd_data.get('interval', 0)
+            cmd_data['optional'] = cmd_data.get('optional', False)
+            cmd_data['cache'] = {}
 
-            if not cmd_data['computed']:
+            if cmd_data['interval'] > 0 and not cmd_data['computed']:
+                cmd_data['poll'] = False
+                cmd_data['next_poll'] = None
+                self._slow.append(cmd_data)
+            else:
+                cmd_data['poll'] = True
+
+            if cmd_data['optional']:
+                self._has_optional = True
+                cmd_data['label'] = '%x:%s' % (cmd_data['cantx'], cmd_data['cmd'].hex())
+                cmd_data['failures'] = 0
+                cmd_data['backoff'] = 0
+                cmd_data['backoff_until'] = 0
+
+            if cmd_data['computed']:
+                cmd_data['decode'] = compile_computed_decoder(cmd_data['fields'])
+            else:
                 # Build a new array instead of inserting into the existing one.
                 # Should be quicker.
                 new_fields = []
+                segments = []
                 for field in cmd_data['fields']:
                     self._log.debug(field)
                     # Non power of two types are hard as is. For now those can
@@ -56,6 +292,15 @@ class IsoTpDecoder:
                         field_fmt = str(field.get('padding')) + 'x'
                         self._log.debug("field_fmt(%s)", field_fmt)
                         fmt += field_fmt
+                    elif field.get('array') and self._arrays:
+                        # Array valued patterned fields are copied as raw
+                        # bytes into one vector per name, skip them in unpack.
+                        segments.append(self._add_vector_segment(field, struct.calcsize(fmt),
+                                                                 bases[field['array']],
+                                                                 cmd_data['interval']))
+                        field_fmt = '%dx' % (field.get('cnt', 1) * field['width'])
+                        self._log.debug("field_fmt(%s)", field_fmt)
+                        fmt += field_fmt
                     elif not field.get('computed', False):
                         # For patterned fields (i.e. cellVolts%02d) use multiplyer
                         # in format string.
@@ -102,49 +347,362 @@ class IsoTpDecoder:
                 self._log.debug("fmt(%s)", fmt)
                 cmd_data['struct'] = struct.Struct(fmt)
                 cmd_data['fields'] = new_fields
+                cmd_data['decode'] = compile_command_decoder(cmd_data['struct'], new_fields,
+                                                             segments)
+
+        self.coalesce_commands()
+        if hasattr(self._dongle, 'register_cyclic'):
+            self.register_cyclic()
+
+    def coalesce_commands(self):
+        """ Find groups which send the same command to the same ECU.
+            Those are requested only once per cycle and all of them
+            decode the shared response. """
+        requests = {}
+        for cmd_data in self._fields:
+            if not cmd_data['computed']:
+                cmd_data['request_key'] = (cmd_data['cmd'], cmd_data['cantx'], cmd_data['canrx'])
+                requests.setdefault(cmd_data['request_key'], []).append(cmd_data)
 
-    def get_data(self):
+        for (cmd, cantx, canrx), groups in requests.items():
+            # Only mandatory single DID reads with a known record length can
+            # be packed into multi DID requests
+            batchable = (cantx in self._multi_did and len(cmd) == 3 and cmd[0] == 0x22 and
+                         len({group['struct'].size for group in groups}) == 1 and
+                         not any(group['optional'] for group in groups))
+
+            for cmd_data in groups:
+                cmd_data['coalesced'] = len(groups) > 1
+                cmd_data['siblings'] = [group for group in groups if group is not cmd_data]
+                cmd_data['batchable'] = batchable
+                # Length of the data record, without response SID and DID
+                cmd_data['record_len'] = cmd_data['struct'].size - 3
+
+            if len(groups) > 1:
+                self._log.info("Coalescing command %s cantx(%x) canrx(%x) of %d groups",
+                               cmd.hex(), cantx, canrx, len(groups))
+
+    def register_cyclic(self):
+        """ Register the single frame requests with the dongle. Only ECUs
+            where all requests qualify are registered, so their responses
+            never mix with requests sent on demand. Slow groups are sent at
+            their interval, fast groups at the dongle's. Registered requests
+            are not packed into multi DID requests. """
+        ecus = {}
+        for cmd_data in self._fields:
+            if not cmd_data['computed']:
+                ecus.setdefault((cmd_data['cantx'], cmd_data['canrx']), []).append(cmd_data)
+
+        requests = []
+        for (cantx, canrx), groups in ecus.items():
+            if all(len(group['cmd']) <= 7 and group['struct'].size <= 7 for group in groups):
+                requests.extend({'cmd': group['cmd'], 'cantx': cantx, 'canrx': canrx,
+                                 'interval': group['interval']} for group in groups)
+
+        registered = self._dongle.register_cyclic(requests)
+        for cmd_data in self._fields:
+            if not cmd_data['computed'] and cmd_data['request_key'] in registered:
+                cmd_data['batchable'] = False
+
+    def _schedule_slow(self, now):
+        """ Select the slow command groups to be polled in this cycle.
+            Groups that never answered are always selected, the others
+            share slow_per_cycle slots round robin. The next poll is only
+            scheduled once a group was decoded, failed groups stay due. """
+        budget = self._slow_per_cycle
+        last_idx = None
+        for idx, cmd_data in enumerate(self._slow):
+            next_poll = cmd_data['next_poll']
+
+            if next_poll is None:
+                cmd_data['poll'] = True
+            elif next_poll <= now and budget > 0:
+                cmd_data['poll'] = True
+                budget -= 1
+                last_idx = idx
+            else:
+                cmd_data['poll'] = False
+
+        # Coalesced groups share the request, poll them together
+        for cmd_data in self._slow:
+            if cmd_data['poll']:
+                for sibling in cmd_data['siblings']:
+                    if sibling['interval'] > 0 and not sibling['poll']:
+                        sibling['poll'] = True
+
+        if last_idx is not None:
+            # Continue after the last polled group in the following cycle
+            self._slow.rotate(-(last_idx + 1))
+
+    def _backoff(self, cmd_data, now):
+        """ Skip a failed optional command for an exponentially
+            growing time """
+        cmd_data['failures'] += 1
+        cmd_data['backoff'] = min(BACKOFF_BASE << (cmd_data['failures'] - 1), BACKOFF_MAX)
+        cmd_data['backoff_until'] = now + cmd_data['backoff']
+        if cmd_data['interval'] > 0:
+            cmd_data['next_poll'] = max(cmd_data['next_poll'] or 0, cmd_data['backoff_until'])
+
+        if cmd_data['failures'] == 1:
+            self._log.info("Optional command %s returned no data, backing off",
+                           cmd_data['label'])
+        else:
+            self._log.debug("Optional command %s failed %d times, backoff %ds",
+                            cmd_data['label'], cmd_data['failures'], cmd_data['backoff'])
+
+    def _fetch_ecu(self, groups, responses, failures):
+        """ Send the due requests of one ECU in order and store the
+            responses, or the errors, in responses. Stops at the first
+            mandatory request without response and appends its error to
+            failures, the cycle fails anyway. """
+        probing = None
+        if self._multi_did:
+            probing, err = self._send_batches(groups, responses)
+            if err is not None:
+                # Only mandatory reads are batched
+                failures.append(err)
+                return
+
+        for cmd_data in groups:
+            key = cmd_data['request_key']
+            if key in responses:
+                continue
+            try:
+                responses[key] = self._dongle.send_command_ex(cmd_data['cmd'],
+                                                              canrx=cmd_data['canrx'],
+                                                              cantx=cmd_data['cantx'])
+            except (NoData, CanError) as err:
+                responses[key] = err
+                if not all(group['optional'] for group in [cmd_data] + cmd_data['siblings']):
+                    failures.append(err)
+                    return
+                continue
+
+            if probing:
+                self._probed_multi_did(probing, cmd_data['cantx'])
+
+    def _due_requests(self, now):
+        """ Return the groups to be requested in this cycle by ECU,
+            in the order of the first group of every ECU """
+        ecus = {}
+        for cmd_data in self._fields:
+            if (not cmd_data['computed'] and cmd_data['poll'] and
+                    not (cmd_data['optional'] and cmd_data['backoff_until'] > now)):
+                ecus.setdefault((cmd_data['cantx'], cmd_data['canrx']), []).append(cmd_data)
+        return ecus
+
+    def _fetch_ordered(self, now, responses, failures):
+        """ Fetch the responses of all due requests ECU by ECU, beginning
+            with the ECU addressed last, so dongles which need to switch
+            headers and filters (AT commands) do so as rarely as possible.
+            Decoding still follows the order of the fields. """
+        ecus = self._due_requests(now)
+        # Stable sort, only moves the last ECU to the front
+        for ecu in sorted(ecus, key=lambda ecu: ecu != self._last_ecu):
+            self._last_ecu = ecu
+            self._fetch_ecu(ecus[ecu], responses, failures)
+            if failures:
+                break
+
+    def _fetch_concurrent(self, now, responses, failures):
+        """ Fetch the responses of all due requests. Each ECU is queried
+            in its own thread, the first one in the calling thread. """
+        ecus = list(self._due_requests(now).values())
+        threads = [Thread(target=self._fetch_ecu, args=(groups, responses, failures),
+                          name="EVNotiPi/ISO-TP-%x" % groups[0]['cantx'])
+                   for groups in ecus[1:]]
+        for thread in threads:
+            thread.start()
+
+        if ecus:
+            self._fetch_ecu(ecus[0], responses, failures)
+
+        for thread in threads:
+            thread.join()
+
+    def _probed_multi_did(self, probing, cantx):
+        """ A single request succeeded after the last multi DID request to
+            the same ECU got no data. The ECU was asleep or ignores multi DID
+            requests; if the next one gets no data as well, it is the latter. """
+        if cantx in probing:
+            self._multi_did_suspect.add(cantx)
+            probing.discard(cantx)
+
+    def _send_batches(self, groups, responses):
+        """ Pack the due single DID reads per ECU into multi DID requests.
+            The responses are split into the responses the single requests
+            would have returned. Returns the ECUs probed with single
+            requests instead and the NoData of a multi DID request, which
+            is not retried with single requests. """
+        batches = {}
+        probing = set()
+        for cmd_data in groups:
+            if (cmd_data['computed'] or not cmd_data['poll'] or not cmd_data['batchable'] or
+                    cmd_data['cantx'] not in self._multi_did):
+                continue
+            if cmd_data['cantx'] in self._multi_did_probe:
+                probing.add(cmd_data['cantx'])
+                continue
+            dids = batches.setdefault((cmd_data['cantx'], cmd_data['canrx']), {})
+            dids.setdefault(cmd_data['cmd'][1:3], cmd_data)
+
+        for cantx in probing:
+            self._multi_did_probe.discard(cantx)
+
+        for (cantx, canrx), dids in batches.items():
+            dids = list(dids.items())
+            for idx in range(0, len(dids), MULTI_DID_MAX):
+                chunk = dids[idx:idx + MULTI_DID_MAX]
+                if len(chunk) < 2:
+                    continue
+
+                cmd = b'\x22' + b''.join(did for did, _ in chunk)
+                try:
+                    raw = self._dongle.send_command_ex(cmd, canrx=canrx, cantx=cantx)
+                    records = self._split_multi_did(raw, chunk)
+                except NoData as err:
+                    if cantx in self._multi_did_suspect:
+                        # It answered the single requests of the last cycle
+                        self._log.warning("ECU %x does not answer multi DID requests, disabled",
+                                          cantx)
+                        self._multi_did.discard(cantx)
+                        self._multi_did_suspect.discard(cantx)
+                        break
+                    if cantx not in self._multi_did_confirmed:
+                        # Asleep or ignoring multi DID requests, find out
+                        # with single requests in the next cycle
+                        self._multi_did_probe.add(cantx)
+                    for _, cmd_data in chunk:
+                        responses[cmd_data['request_key']] = err
+                    return probing, err
+                except (CanError, ValueError) as err:
+                    self._log.warning("ECU %x rejected multi DID request %s (%s), disabled",
+                                      cantx, cmd.hex(), err)
+                    self._multi_did.discard(cantx)
+                    break
+
+                self._multi_did_confirmed.add(cantx)
+                self._multi_did_suspect.discard(cantx)
+                for cmd_data, record in records:
+                    responses[cmd_data['request_key']] = record
+
+        return probing, None
+
+    @staticmethod
+    def _split_multi_did(raw, chunk):
+        """ Split the response of a multi DID request into single responses """
+        if len(raw) == 0 or raw[0] != 0x62:
+            raise ValueError('negative response %s' % raw.hex())
+
+        records = []
+        pos = 1
+        for did, cmd_data in chunk:
+            end = pos + 2 + cmd_data['record_len']
+            if raw[pos:pos + 2] != did or end > len(raw):
+                raise ValueError('unexpected response %s' % raw.hex())
+            records.append((cmd_data, b'\x62' + raw[pos:end]))
+            pos = end
+
+        return records
+
+    def field_names(self):
+        """ Return the names of all fields get_data can set """
+        names = []
+        for cmd_data in self._fields:
+            names.extend(field['name'] for field in cmd_data['fields'] if 'name' in field)
+        names.extend(self._vectors)
+        if self._has_optional:
+            names.append('optionalBackoff')
+        return names
+
+    def get_data(self, data=None):
         """ Takes a structure which describes adresses,
-            commands and how to decode the return """
+            commands and how to decode the return. Decodes into
+            data if given, else into a new dict. The values are
+            collected in a dict and put into data at the end, item
+            assignment on a Sample is slower. """
+        now = monotonic()
+        if self._slow:
+            self._schedule_slow(now)
+
+        target = data
         data = {}
+        responses = {}
+        failures = []
+        switches = getattr(self._dongle, 'header_switches', None)
+        if self._concurrent:
+            self._fetch_concurrent(now, responses, failures)
+        else:
+            self._fetch_ordered(now, responses, failures)
+        if failures:
+            # A mandatory request failed, don't send the remaining ones
+            raise failures[0]
+
+        vectors_published = not self._vectors
         for cmd_data in self._fields:
             try:
-                if cmd_data['computed']:
+                if not cmd_data['poll'] or (cmd_data['optional'] and
+                                            cmd_data['backoff_until'] > now):
+                    # Slow group or backing off, carry forward the cached values
+                    data.update(cmd_data['cache'])
+                elif cmd_data['computed']:
+                    # Vectors need to be in place for computed fields
+                    if not vectors_published:
+                        self._publish_vectors(data)
+                        vectors_published = True
                     # Fields of computed "commands" are filled by executing
                     # the fields lambda with the data dict as argument
-                    for field in cmd_data['fields']:
-                        name = field['name']
-                        func = field['lambda']
-                        data[name] = func(data)
+                    cmd_data['decode'](data)
                 else:
-                    # Send a command to the CAN bus and parse the resulting
-                    # bytearray using unpack. The format for unpack was generated
-                    # in the preprocessor. Extracted values are scaled, shifted
-                    # and a lambda function is executed if provided
-                    raw = self._dongle.send_command_ex(cmd_data['cmd'],
-                                                       canrx=cmd_data['canrx'],
-                                                       cantx=cmd_data['cantx'])
-                    raw_fields = cmd_data['struct'].unpack(raw)
-
-                    for field in cmd_data['fields']:
-                        name = field['name']
-                        fmt_idx = field['fmt_idx']
-                        fmt_len = field['fmt_len']
-
-                        if 'lambda' in field:
-                            value = field['lambda'](raw_fields[fmt_idx:fmt_idx+fmt_len])
-                        else:
-                            value = raw_fields[fmt_idx]
+                    # Parse the response fetched for the command using the
+                    # decoder compiled in the preprocessor. It unpacks the
+                    # response, scales and shifts the values and executes
+                    # lambda functions where provided.
+                    raw = responses[cmd_data['request_key']]
+                    if isinstance(raw, Exception):
+                        raise raw
+                    if cmd_data['interval'] > 0 or cmd_data['optional']:
+                        # Keep the values to carry them forward
+                        cache = {}
+                        cmd_data['decode'](raw, cache)
+                        cmd_data['cache'] = cache
+                        if cmd_data['interval'] > 0:
+                            cmd_data['next_poll'] = now + cmd_data['interval']
+                        data.update(cache)
+                    else:
+                        cmd_data['decode'](raw, data)
 
-                        data[name] = value * field['scale'] + field['offset']
+                    if cmd_data['optional'] and cmd_data['failures']:
+                        self._log.info("Optional command %s answers again", cmd_data['label'])
+                        cmd_data['failures'] = 0
+                        cmd_data['backoff'] = 0
 
             except NoData:
-                if not cmd_data.get('optional', False):
+                if not cmd_data['optional']:
                     raise
+                self._backoff(cmd_data, now)
+                data.update(cmd_data['cache'])
             except struct.error as err:
                 self._log.error("err(%s) cmd(%s) fmt(%s):%d raw(%s):%d", err, cmd_data['cmd'].hex(),
                                 cmd_data['struct'].format, cmd_data['struct'].size,
                                 raw.hex(), len(raw))
                 raise
 
-        return data
+        if not vectors_published:
+            self._publish_vectors(data)
+
+        if switches is not None:
+            switches = self._dongle.header_switches - switches
+            if switches != self._cycle_switches:
+                self._log.debug("Header switches per cycle: %d", switches)
+                self._cycle_switches = switches
+
+        if self._has_optional:
+            data['optionalBackoff'] = {cmd_data['label']: cmd_data['backoff']
+                                       for cmd_data in self._fields
+                                       if cmd_data['optional'] and cmd_data['backoff_until'] > now}
+
+        if target is None:
+            return data
+        target.update(data)
+        return target
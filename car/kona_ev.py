@@ -21,7 +21,8 @@ Fields = (
          {'name': 'dcBatteryVoltage', 'width': 2, 'scale': .1},
          {'name': 'batteryMaxTemperature', 'width': 1, 'signed': True},
          {'name': 'batteryMinTemperature', 'width': 1, 'signed': True},
-         {'name': 'cellTemp%02d', 'idx': 1, 'cnt': 4, 'width': 1, 'signed': True},
+         {'name': 'cellTemp%02d', 'idx': 1, 'cnt': 4, 'width': 1, 'signed': True,
+          'array': 'cellTemps'},
          {'padding': 2},
          {'name': 'batteryInletTemperature', 'width': 1, 'signed': True},
          {'padding': 6},
@@ -35,22 +36,25 @@ Fields = (
          {'padding': 8},
      )
      },
-    {'cmd': b220102, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b220102, 'canrx': 0x7ec, 'cantx': 0x7e4, 'interval': 10,
      'fields': (
          {'padding': 7},
-         {'name': 'cellVoltage%02d', 'idx': 1, 'cnt': 32, 'width': 1, 'scale': .02},
+         {'name': 'cellVoltage%02d', 'idx': 1, 'cnt': 32, 'width': 1, 'scale': .02,
+          'array': 'cellVoltages'},
      )
      },
-    {'cmd': b220103, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b220103, 'canrx': 0x7ec, 'cantx': 0x7e4, 'interval': 10,
      'fields': (
          {'padding': 7},
-         {'name': 'cellVoltage%02d', 'idx': 33, 'cnt': 32, 'width': 1, 'scale': .02},
+         {'name': 'cellVoltage%02d', 'idx': 33, 'cnt': 32, 'width': 1, 'scale': .02,
+          'array': 'cellVoltages'},
      )
      },
-    {'cmd': b220104, 'canrx': 0x7ec, 'cantx': 0x7e4,
+    {'cmd': b220104, 'canrx': 0x7ec, 'cantx': 0x7e4, 'interval': 10,
      'fields': (
          {'padding': 7},
-         {'name': 'cellVoltage%02d', 'idx': 65, 'cnt': 32, 'width': 1, 'scale': .02},
+         {'name': 'cellVoltage%02d', 'idx': 65, 'cnt': 32, 'width': 1, 'scale': .02,
+          'array': 'cellVoltages'},
      )
      },
     {'cmd': b220105, 'canrx': 0x7ec, 'cantx': 0x7e4,
@@ -63,6 +67,7 @@ Fields = (
      )
      },
     {'cmd': b22b002, 'canrx': 0x7ce, 'cantx': 0x7c6, 'optional': True,
+     'interval': 60,
      'fields': (
          {'padding': 9},
          {'name': 'odo', 'width': 3},
@@ -90,12 +95,14 @@ class KonaEv(Car):
     def __init__(self, config, dongle, watchdog, gps):
         Car.__init__(self, config, dongle, watchdog, gps)
         self._dongle.set_protocol('CAN_11_500')
-        self._isotp = IsoTpDecoder(self._dongle, Fields)
+        self._isotp = IsoTpDecoder(self._dongle, Fields,
+                                   arrays=config.get('cell_arrays', False))
+        self.extend_schema(self.get_base_data(), self._isotp.field_names())
 
     def read_dongle(self, data):
         """ Read and parse data from dongle """
         data.update(self.get_base_data())
-        data.update(self._isotp.get_data())
+        self._isotp.get_data(data)
 
     def get_base_data(self):
         return {
@@ -0,0 +1,126 @@
+""" Compact record for the data of one polling cycle """
+from collections.abc import Mapping, MutableMapping
+
+# Marks empty slots, None is a valid value
+MISSING = object()
+
+
+class SampleSchema:
+    """ The field names of the samples of one car, mapped to the index of
+        their slot. Samples of the same schema share names and index. """
+    __slots__ = ('names', 'index')
+
+    def __init__(self, names=()):
+        self.names = tuple(dict.fromkeys(names))
+        self.index = {name: idx for idx, name in enumerate(self.names)}
+
+    def extend(self, names):
+        """ Return a schema with names added """
+        return SampleSchema(self.names + tuple(names))
+
+
+class Sample(MutableMapping):
+    """ Data of one polling cycle with dict like access. Fields of the
+        schema are held in a list of slots, other keys go into an
+        overflow dict that is only created when needed. Array valued
+        fields like the cell voltages take one slot with their vector. """
+    __slots__ = ('_names', '_index', '_values', '_extra')
+
+    def __init__(self, schema, values=None):
+        self._names = schema.names
+        self._index = schema.index
+        self._values = [MISSING] * len(schema.names)
+        self._extra = None
+        if values:
+            self.update(values)
+
+    def __getitem__(self, key):
+        try:
+            value = self._values[self._index[key]]
+        except KeyError:
+            if self._extra is None:
+                raise
+            return self._extra[key]
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        try:
+            self._values[self._index[key]] = value
+        except KeyError:
+            if self._extra is None:
+                self._extra = {key: value}
+            else:
+                self._extra[key] = value
+
+    def __delitem__(self, key):
+        idx = self._index.get(key)
+        if idx is not None and self._values[idx] is not MISSING:
+            self._values[idx] = MISSING
+        elif idx is None and self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        idx = self._index.get(key)
+        if idx is not None:
+            return self._values[idx] is not MISSING
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for name, value in zip(self._names, self._values):
+            if value is not MISSING:
+                yield name
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return (len(self._values) - self._values.count(MISSING) +
+                (len(self._extra) if self._extra is not None else 0))
+
+    def __repr__(self):
+        return 'Sample(%r)' % dict(self.items())
+
+    def get(self, key, default=None):
+        idx = self._index.get(key)
+        if idx is not None:
+            value = self._values[idx]
+            return default if value is MISSING else value
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def items(self):
+        """ Return the (name, value) pairs of the set fields """
+        items = [(name, value) for name, value in zip(self._names, self._values)
+                 if value is not MISSING]
+        if self._extra is not None:
+            items.extend(self._extra.items())
+        return items
+
+    def update(self, other=(), **kwargs):
+        """ Update from a mapping or (key, value) pairs and kwargs """
+        index = self._index
+        values = self._values
+        items = iter(other.items() if isinstance(other, Mapping) else other)
+        while True:
+            try:
+                for key, value in items:
+                    values[index[key]] = value
+                break
+            except KeyError:
+                # Not in the schema, continue after it with the next item
+                self[key] = value
+        if kwargs:
+            self.update(kwargs)
+
+    def copy(self):
+        """ Return a shallow copy """
+        sample = Sample.__new__(Sample)
+        sample._names = self._names
+        sample._index = self._index
+        sample._values = self._values.copy()
+        sample._extra = None if self._extra is None else self._extra.copy()
+        return sample
@@ -1,9 +1,53 @@
 """ Module for the Renault Zoe Z.E.40 """
-from time import time
-from threading import Thread, Lock
+from time import time, sleep
+from threading import Thread
 import logging
-from .car import Car, ifbu, ifbs
-from dongle import NoData
+from .car import Car
+from .broadcast_decoder import BroadcastDecoder
+from .dbc import load_dbc
+from dongle import NoData, CanError
+
+# Seconds the reader waits after the dongle failed to read frames
+READ_ERROR_BACKOFF = 1
+
+# Attempts of read_dongle to copy a snapshot before the reader swaps it
+SNAPSHOT_RETRIES = 3
+
+# Broadcast messages of the Zoe, start bits in DBC notation (big endian)
+Messages = (
+    {'can_id': 0x42e, 'signals': (
+        {'name': 'SOC_DISPLAY', 'start': 7, 'length': 13, 'scale': 0.02},
+        {'name': 'dcBatteryVoltage', 'start': 30, 'length': 10, 'scale': 0.5},
+        {'name': 'batteryMaxTemperature', 'start': 43, 'length': 7, 'offset': -40},
+        {'name': 'batteryMinTemperature', 'start': 43, 'length': 7, 'offset': -40},
+        )},
+    {'can_id': 0x5d7, 'signals': (
+        {'name': 'odo', 'start': 23, 'length': 28, 'scale': 0.01},
+        )},
+    {'can_id': 0x638, 'signals': (
+        {'name': 'dcBatteryPower', 'start': 7, 'length': 8, 'offset': -80.0},
+        )},
+    {'can_id': 0x654, 'signals': (
+        {'name': 'normalChargePort', 'start': 5, 'length': 1},
+        )},
+    {'can_id': 0x656, 'signals': (
+        {'name': 'externalTemperature', 'start': 55, 'length': 8, 'offset': -40.0},
+        )},
+    {'can_id': 0x658, 'signals': (
+        {'name': 'soh', 'start': 38, 'length': 7},
+        {'name': 'charging', 'start': 45, 'length': 1},
+        )},
+    {'can_id': 0x6f8, 'signals': (
+        {'name': 'auxBatteryVoltage', 'start': 23, 'length': 8, 'scale': 0.0625},
+        )},
+    #{'can_id': 0x637, 'signals': (
+    #    {'name': 'cumulativeEnergyCharged', 'start': 47, 'length': 12},
+    #    )},
+    #{'can_id': 0x652, 'signals': (
+    #    {'name': 'cumulativeEnergyDischarged', 'start': 37, 'length': 14},
+    #    )},
+    )
+
 
 class Zoe(Car):
 
@@ -12,28 +56,26 @@ class Zoe(Car):
             config['interval'] = 1
 
         Car.__init__(self, config, dongle, watchdog, gps)
+        if 'dbc' in config:
+            messages = load_dbc(config['dbc'], config.get('dbc_signals'))
+        else:
+            messages = Messages
+        self._decoder = BroadcastDecoder(messages)
+        self.extend_schema(*self._decoder.signal_names.values(), ('signalAge',))
         self._dongle.set_protocol('CAN_11_500')
-        self._dongle.set_raw_filters_ex([
-            {'id': 0x1f6, 'mask': 0x7ff},
-            {'id': 0x29a, 'mask': 0x7ff},
-            {'id': 0x35c, 'mask': 0x7ff},
-            {'id': 0x427, 'mask': 0x7ff},
-            {'id': 0x42e, 'mask': 0x7ff},
-            {'id': 0x5d7, 'mask': 0x7ff},
-            {'id': 0x637, 'mask': 0x7ff},
-            {'id': 0x638, 'mask': 0x7ff},
-            {'id': 0x652, 'mask': 0x7ff},
-            {'id': 0x654, 'mask': 0x7ff},
-            {'id': 0x656, 'mask': 0x7ff},
-            {'id': 0x658, 'mask': 0x7ff},
-            {'id': 0x6f8, 'mask': 0x7ff},
-            {'id': 0x7bb, 'mask': 0x7ff},
-            ])
-        self._data = self.get_base_data()
-        self._data = {}
-        self._data_lock = Lock()
+        self._dongle.set_raw_filters_ex(self._decoder.get_filters())
+        # Double buffered decoded values and the time each one was last
+        # updated, None if never. The reader thread decodes into the back
+        # buffer and publishes it as _snapshot, then increments
+        # _generation. Both buffers hold every signal from the start, so
+        # their size never changes while read_dongle iterates them.
+        names = [name for names in self._decoder.signal_names.values() for name in names]
+        self._buffers = [(dict.fromkeys(names), dict.fromkeys(names)) for _ in range(2)]
+        self._snapshot = self._buffers[0]
+        self._generation = 0
+        self._max_age = config.get('max_age', 5)
         self._last_data = 0
-        self._reader_thread = Thread(name="Zoe-Reader-Thread", target=self._reader_thread)
+        self._reader_thread = Thread(name="Zoe-Reader-Thread", target=self.reader_thread)
         self._reader_running = False
 
     def start(self):
@@ -48,83 +90,76 @@ class Zoe(Car):
         Car.stop(self)
 
     def reader_thread(self):
+        decoders = self._decoder.decoders
+        signal_names = self._decoder.signal_names
+        # Messages decoded into the published buffer only
+        behind = set()
         while self._reader_running:
             try:
-                data = self._dongle.read_raw_frame(1)
-                self._last_data = time()
+                frames = self._dongle.read_raw_frames(1)
+                if not frames:
+                    continue
+                now = time()
+                self._last_data = now
 
-                with self._data_lock:
-                    can_id = data['can_id']
-                    msg = data['data']
+                # Bring the back buffer up to date with the published one
+                front_values, front_stamps = self._snapshot
+                back = self._buffers[self._buffers[0] is self._snapshot]
+                values, stamps = back
+                for can_id in behind:
+                    for name in signal_names[can_id]:
+                        values[name] = front_values[name]
+                        stamps[name] = front_stamps[name]
 
+                updated = set()
+                for can_id, msg in frames:
                     if self._log.isEnabledFor(logging.DEBUG):
                         self._log.debug("data can_id(%x) msg(%s)", can_id, msg.hex())
 
-                    if can_id == 0x42e:
-                        self._data.update({
-                            'SOC_DISPLAY':                  (ifbu(msg[0:2]) >> 3 & 0x1fff) * 0.02,
-                            })
-                        self._data.update({
-                            'dcBatteryVoltage':             (ifbu(msg[3:5]) >> 5 & 0x03ff) * 0.5,
-                            'batteryMaxTemperature':        (ifbu(msg[5:7]) >> 5 & 0x007f) - 40,
-                            'batteryMinTemperature':        (ifbu(msg[5:7]) >> 5 & 0x007f) - 40,
-                            })
-                        if 'dcBatteryPower' in self._data:
-                            self._data['dcBatteryCurrent'] = \
-                                self._data['dcBatteryPower'] / self._data['dcBatteryVoltage']
-                    #elif can_id == 0x637:
-                    #    self._data.update({
-                    #        'cumulativeEnergyCharged':      ifbu(msg[5:7]) >> 4 & 0x0fff,
-                    #        })
-                    elif can_id == 0x5d7:
-                        self._data.update({
-                            'odo':                          (ifbu(msg[2:6]) >> 4) * 0.01,
-                            })
-                    elif can_id == 0x638:
-                        self._data.update({
-                            'dcBatteryPower':               msg[0] - 80.0,
-                            })
-                        if 'dcBatteryVoltage' in self._data:
-                            self._data['dcBatteryCurrent'] = \
-                                self._data['dcBatteryPower'] / self._data['dcBatteryVoltage']
-                    #elif can_id == 0x652:
-                    #    self._data.update({
-                    #        'cumulativeEnergyDischarged':   ifbu(msg[4:6]) & 0x3fff,
-                    #        })
-                    elif can_id == 0x654:
-                        cpc = msg[0] >> 5 & 0x1
-                        #ect = msg[2] >> 6 & 0x3
-
-                        self._data.update({
-                            'normalChargePort':             int(cpc == 1),
-                            })
-                    elif can_id == 0x656:
-                        self._data.update({
-                            'outcan_ideTemp':               msg[6] - 40.0,
-                            })
-                    elif can_id == 0x658:
-                        self._data.update({
-                            'charging':                     msg[5] >> 5 & 0x1,
-                            'soh':                          msg[4] & 0x7f,
-                            })
-                    elif can_id == 0x6f8:
-                        self._data.update({
-                            'auxBatteryVoltage':            msg[2] * 0.0625,
-                            })
-                    #elif can_id == 0x7bb:
-                    #    self._data.update({
-                    #        'SOC_BMS':                      msg[] * 0.01,
-                    #        })
-                    #elif can_id == 0x7ec:
-                    #    self._data.update({
-                    #        '
+                    decode = decoders.get(can_id)
+                    if decode is not None:
+                        decode(msg, values)
+                        updated.add(can_id)
+
+                for can_id in updated:
+                    for name in signal_names[can_id]:
+                        stamps[name] = now
+                behind = updated
+
+                # Publish, from now on the other buffer is written
+                self._snapshot = back
+                self._generation += 1
 
             except NoData:
                 self._log.debug('NoData')
+            except CanError as err:
+                # Bus or socket error, keep reading after a pause
+                self._log.warning("Reading frames failed: %s", err)
+                sleep(READ_ERROR_BACKOFF)
 
     def read_dongle(self, data):
-        with self._data_lock:
-            data.update(self._data)
+        """ Copy the published signals into data without locking. Signals
+            whose message was not received for max_age seconds are left
+            out, signalAge holds the age of every received signal. """
+        now = time()
+        for _ in range(SNAPSHOT_RETRIES):
+            generation = self._generation
+            values, stamps = self._snapshot
+            signals = [(name, values[name], stamp) for name, stamp in stamps.items()
+                       if stamp is not None]
+            # The reader thread writes the buffer only after swapping,
+            # copy again if it did
+            if self._generation == generation:
+                break
+
+        oldest = now - self._max_age
+        for name, value, stamp in signals:
+            if stamp >= oldest:
+                data[name] = value
+        data['signalAge'] = {name: now - stamp for name, _, stamp in signals}
+
+        if data.get('dcBatteryPower') is not None and data.get('dcBatteryVoltage'):
+            data['dcBatteryCurrent'] = data['dcBatteryPower'] / data['dcBatteryVoltage']
 
     def get_base_data(self):
         raise NotImplementedError()
@@ -22,7 +22,7 @@ CMD_CURRENT = bytes.fromhex('229257')  # EVC berechneter Strom
 CMD_SOH = bytes.fromhex('223206')  # EVC
 
 Fields = [
-    {'cmd': CMD_AUX_VOLTAGE, 'canrx': EVC_RX, 'cantx': EVC_TX,
+    {'cmd': CMD_AUX_VOLTAGE, 'canrx': EVC_RX, 'cantx': EVC_TX, 'interval': 10,
      'fields': (
          {'padding': 3},
          {'name': 'auxBatteryVoltage', 'width': 2, 'scale': .01},
@@ -52,19 +52,19 @@ Fields = [
          {'name': 'dcBatteryVoltage', 'width': 4, 'scale': .001},
      )
      },
-    {'cmd': CMD_BMS_ENERGY, 'canrx': LBC_RX, 'cantx': LBC_TX,
+    {'cmd': CMD_BMS_ENERGY, 'canrx': LBC_RX, 'cantx': LBC_TX, 'interval': 60,
      'fields': (
          {'padding': 3},
          {'name': 'cumulativeEnergyCharged', 'width': 4, 'scale': .001},
      )
      },
-    {'cmd': CMD_ODO, 'canrx': EVC_RX, 'cantx': EVC_TX,
+    {'cmd': CMD_ODO, 'canrx': EVC_RX, 'cantx': EVC_TX, 'interval': 60,
      'fields': (
          {'padding': 3},
          {'name': 'odo', 'width': 3},
      )
      },
-    {'cmd': CMD_NRG_DISCHARG, 'canrx': LBC_RX, 'cantx': LBC_TX,
+    {'cmd': CMD_NRG_DISCHARG, 'canrx': LBC_RX, 'cantx': LBC_TX, 'interval': 60,
      'fields': (
          {'padding': 3},
          {'name': 'cumulativeEnergyDischarged', 'width': 4, 'scale': .001},
@@ -124,12 +124,14 @@ class ZoeZe50(Car):
         #                   })
         ##    idx += 1
 
-        self._isotp = IsoTpDecoder(self._dongle, Fields)
+        self._isotp = IsoTpDecoder(self._dongle, Fields,
+                                   multi_did=(LBC_TX, EVC_TX, BCB_TX))
+        self.extend_schema(self.get_base_data(), self._isotp.field_names())
 
     def read_dongle(self, data):
         """ Read and parse data from dongle """
         data.update(self.get_base_data())
-        data.update(self._isotp.get_data())
+        self._isotp.get_data(data)
 
     @staticmethod
     def get_base_data():
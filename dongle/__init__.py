@@ -3,6 +3,7 @@ from importlib import import_module
 
 Modules = {
     'ELM327': {'f': 'elm327', 'c': 'Elm327'},
+    'STN11xx': {'f': 'stn11xx', 'c': 'Stn11xx'},
     'PiOBD2Hat': {'f': 'pi_obd_hat', 'c': 'PiObd2Hat'},
     'SocketCAN': {'f': 'socket_can', 'c': 'SocketCan'},
     'FakeDongle': {'f': 'fake_dongle', 'c': 'FakeDongle'},
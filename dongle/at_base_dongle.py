@@ -1,23 +1,57 @@
 """ Implement base class for ELM327-ish serial donghles """
+from binascii import a2b_hex
 from threading import Lock
-from time import sleep
+from time import monotonic
 import math
 import logging
 import serial
 from . import NoData, CanError
 
+# Largest number of response frames that can be appended to a command
+MAX_COUNT_HINT = 0xf
+
+# Time to wait for each step of switching the serial speed, longer than
+# the 75 ms the dongle waits for our answer, and number of timeouts in a
+# row after which a negotiated speed is given up
+SPEED_SWITCH_TIMEOUT = 0.5
+SPEED_FALLBACK_TIMEOUTS = 3
+
+# Value of the ASCII hex digits
+HexDigits = {char: int(chr(char), 16) for char in b'0123456789abcdefABCDEF'}
+# Line separators and frame type of consecutive frames
+CR = b'\r'
+LF = b'\n'
+CF = b'2'
+# Indexes of the consecutive frames of a response in order
+FrameIndexes = b'123456789ABCDEF0' * 0x100
+
 
 class AtBase:
     """ Base class for ELM327 and similar """
 
+    # Serial speeds the dongle can be switched to, see negotiate_speed
+    Speeds = ()
+    # Largest number of response frames format_request can pass on
+    MaxCountHint = MAX_COUNT_HINT
+
     def __init__(self, dongle):
         self._log = logging.getLogger("EVNotiPi/%s" % __name__)
         self._log.info("Initializing OBD2 interface")
 
         self._serial_lock = Lock()
+        # Time to wait for the prompt after sending a command
+        self._timeout = dongle.get('timeout', 5)
+        # Configured speed, used until a faster one was negotiated and
+        # after the dongle stopped responding at that
+        self._speed = dongle['speed']
+        self._speed_file = dongle.get('speed_file', 'dongle_speed')
+        self._timeouts = 0
+        self._protocol = None
         self._serial = serial.Serial(dongle['port'],
                                      baudrate=dongle['speed'],
                                      timeout=1)
+        if dongle.get('max_speed') and hasattr(self, 'speed_command'):
+            self._resume_speed()
         self.init_dongle()
 
         self._config = dongle
@@ -25,11 +59,19 @@ class AtBase:
         self._current_canid = 0
         self._current_canfilter = 0
         self._current_canmask = 0
+        # Number of AT commands sent to change header, filter or mask
+        self.header_switches = 0
+        # Learned number of response frames by (cantx, canrx, cmd)
+        self._count_hints = dongle.get('count_hints', False)
+        self._response_counts = {}
         self._is_extended = False
         # These need to be redefined by the actual dongle module
         self._ret_no_data = None
         self._ret_can_error = None
 
+        if dongle.get('max_speed') and hasattr(self, 'speed_command'):
+            self.negotiate_speed(dongle['max_speed'])
+
     def init_dongle(self):
         """ Empty method, needs to be overriden"""
         raise NotImplementedError()
@@ -46,6 +88,33 @@ class AtBase:
         """ Empty method, needs to be overriden"""
         raise NotImplementedError()
 
+    def _read_until(self, markers, timeout):
+        """ Read from the dongle until one of markers was received and
+            return everything read. Raises SerialTimeoutException if none
+            arrived within timeout seconds. Call with the lock held. """
+        ret = bytearray()
+        read_timeout = self._serial.timeout
+        deadline = monotonic() + timeout
+        if timeout < read_timeout:
+            self._serial.timeout = timeout
+        try:
+            while True:
+                # Block until at least one byte arrived, then take
+                # everything that is waiting
+                ret.extend(self._serial.read(max(1, self._serial.in_waiting)))
+
+                if any(marker in ret for marker in markers):
+                    return ret
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise serial.SerialTimeoutException()
+                if remaining < self._serial.timeout:
+                    self._serial.timeout = remaining
+        finally:
+            if self._serial.timeout != read_timeout:
+                self._serial.timeout = read_timeout
+
     def talk_to_dongle(self, cmd, expect=None):
         """ Send command to dongle and return the response as string. """
         try:
@@ -53,23 +122,11 @@ class AtBase:
                 while self._serial.in_waiting:   # Clear the input buffer
                     self._log.warning("Stray data in buffer: %s",
                                       self._serial.read(self._serial.in_waiting))
-                    sleep(0.1)
 
                 self._log.debug("Send command: %s", cmd)
                 self._serial.write(bytes(cmd + '\r\n', 'ascii'))
-                ret = bytearray()
-                while True:
-                    if not self._serial.in_waiting:
-                        sleep(0.1)
-                        continue
-                    data = self._serial.read(self._serial.in_waiting)
-
-                    endidx = data.find(b'>')
-                    if endidx >= 0:
-                        ret.extend(data[:endidx])
-                        break
-
-                    ret.extend(data)
+                ret = self._read_until((b'>',), self._timeout)
+                del ret[ret.find(b'>'):]
 
                 self._log.debug("Received: %s", ret)
 
@@ -80,9 +137,146 @@ class AtBase:
 
         except serial.SerialTimeoutException:
             ret = b'TIMEOUT'
+            self._timeouts += 1
+            if (self._timeouts >= SPEED_FALLBACK_TIMEOUTS and
+                    self._serial.baudrate != self._speed):
+                self._fall_back_speed()
+        else:
+            self._timeouts = 0
 
         return ret.strip(b'\r\n')
 
+    def negotiate_speed(self, max_speed):
+        """ Switch the dongle to faster serial speeds step by step up to
+            max_speed, stopping at the first one it does not switch to.
+            The speed remembered from the last run is tried first. The
+            dongle module lists its speeds in Speeds and provides the
+            switch command in speed_command(speed). """
+        speeds = [speed for speed in self.Speeds
+                  if self._serial.baudrate < speed <= max_speed]
+        if not speeds:
+            return
+
+        ident = self.send_at_cmd('ATI', None)
+        remembered = self._load_speed()
+        if remembered in speeds:
+            if self._switch_speed(remembered, ident):
+                speeds = [speed for speed in speeds if speed > remembered]
+            else:
+                speeds = [speed for speed in speeds if speed < remembered]
+
+        for speed in speeds:
+            if not self._switch_speed(speed, ident):
+                break
+
+        if self._serial.baudrate != remembered:
+            self._save_speed(self._serial.baudrate)
+        self._log.info("Using serial speed %d", self._serial.baudrate)
+
+    def _resume_speed(self):
+        """ The dongle keeps a negotiated speed until it is reset or
+            powered off, e.g. over a restart of the service. Probe the
+            remembered speed with a single ATI and stay there if the dongle
+            answers, else continue at the configured speed. """
+        speed = self._load_speed()
+        if speed is None or speed == self._speed:
+            return
+
+        with self._serial_lock:
+            self._serial.baudrate = speed
+            self._serial.reset_input_buffer()
+            self._serial.write(b'ATI\r')
+            try:
+                ret = self._read_until((b'>',), SPEED_SWITCH_TIMEOUT)
+                # At the wrong speed the bytes received are garbage
+                if all(32 <= char < 127 or char in b'\r\n' for char in ret):
+                    self._log.info("Dongle still at serial speed %d", speed)
+                    return
+            except serial.SerialTimeoutException:
+                pass
+
+            self._log.info("Dongle not at serial speed %d, using %d", speed, self._speed)
+            self._serial.baudrate = self._speed
+            # End the garbage the dongle received, it answers with ?
+            self._serial.write(b'\r')
+            try:
+                self._read_until((b'>',), SPEED_SWITCH_TIMEOUT)
+            except serial.SerialTimeoutException:
+                pass
+            self._serial.reset_input_buffer()
+
+    def _switch_speed(self, speed, ident):
+        """ Switch the dongle to speed. The dongle confirms the command at
+            the old speed, then sends its ident at the new one and expects
+            a carriage return in time, otherwise it goes back to the old
+            speed and shows the prompt there. """
+        cmd = self.speed_command(speed)
+        old_speed = self._serial.baudrate
+        with self._serial_lock:
+            self._serial.reset_input_buffer()
+            self._log.debug("Send command: %s", cmd)
+            self._serial.write(bytes(cmd + '\r', 'ascii'))
+            try:
+                ret = self._read_until((b'OK', b'?'), SPEED_SWITCH_TIMEOUT)
+                if b'OK' not in ret:
+                    self._log.info("Dongle does not support %s", cmd)
+                    if b'>' not in ret:
+                        self._read_until((b'>',), self._timeout)
+                    return False
+
+                self._serial.baudrate = speed
+                self._read_until((ident,), SPEED_SWITCH_TIMEOUT)
+                self._serial.write(b'\r')
+                self._read_until((b'>',), SPEED_SWITCH_TIMEOUT)
+                self._log.info("Switched serial speed to %d", speed)
+                return True
+
+            except serial.SerialTimeoutException:
+                # The dongle is back at the old speed by now, its prompt
+                # was sent while we were listening at the new one
+                self._log.info("Dongle did not switch to %d, staying at %d",
+                               speed, old_speed)
+                self._serial.baudrate = old_speed
+                self._serial.reset_input_buffer()
+                return False
+
+    def _fall_back_speed(self):
+        """ The dongle stopped responding at the negotiated speed, it was
+            probably reset. Continue at the configured speed and set the
+            dongle up again. """
+        speed = self._serial.baudrate
+        self._log.warning("Dongle not responding at %d, falling back to %d",
+                          speed, self._speed)
+        self._serial.baudrate = self._speed
+        self._timeouts = 0
+        if self.talk_to_dongle('ATI') == b'TIMEOUT':
+            self._log.error("Dongle not responding at %d either", self._speed)
+            self._serial.baudrate = speed
+            return
+
+        self._current_canid = 0
+        self._current_canfilter = 0
+        self._current_canmask = 0
+        self.init_dongle()
+        if self._protocol is not None:
+            self.set_protocol(self._protocol)
+
+    def _load_speed(self):
+        """ Return the speed remembered in the speed file or None """
+        try:
+            with open(self._speed_file, encoding='ascii') as speed_file:
+                return int(speed_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def _save_speed(self, speed):
+        """ Remember speed for the next start """
+        try:
+            with open(self._speed_file, 'w', encoding='ascii') as speed_file:
+                speed_file.write('%d\n' % speed)
+        except OSError as err:
+            self._log.warning("Can not write %s: %s", self._speed_file, err)
+
     def send_at_cmd(self, cmd, expect='OK'):
         """ Send AT command to dongle and return response. """
         ret = self.talk_to_dongle(cmd, expect)
@@ -146,12 +340,21 @@ class AtBase:
         """ Convert bytearray "cmd" to string,
             send to dongle and parse the reponse.
             Also handles filters and masks. """
-        cmd = cmd.hex()
+        current = (self._current_canid, self._current_canfilter, self._current_canmask)
         self.set_can_id(cantx)
         self.set_can_rx_filter(canrx)
         self.set_can_rx_mask(0x1fffffff if self._is_extended else 0x7ff)
+        self.header_switches += sum(old != new for old, new in zip(
+            current, (self._current_canid, self._current_canfilter, self._current_canmask)))
+        self.prepare_request(cantx)
 
-        ret = self.talk_to_dongle(cmd)
+        key = (cantx, canrx, cmd)
+        hint = self._response_counts.get(key)
+        cmd = cmd.hex()
+
+        start = monotonic()
+        ret = self.talk_to_dongle(self.format_request(cmd, cantx, hint))
+        elapsed = monotonic() - start
 
         if ret in self._ret_no_data:
             raise NoData(ret)
@@ -160,58 +363,150 @@ class AtBase:
             raise CanError("Failed Command %s\n%s" % (cmd, ret))
 
         try:
-            data = None
-            data_len = 0
-            last_idx = 0
-            raw = str(ret, 'ascii').split('\r\n')
+            data, frames = self.parse_response(cmd, ret)
+        except CanError:
+            if hint is None:
+                raise
+            if ret == b'?':
+                # Some clones do not understand the appended frame count
+                self._log.warning("Dongle rejected %s with frame count, disabling count hints",
+                                  cmd)
+                self._count_hints = False
+                self._response_counts.clear()
+            else:
+                # The response was cut short, the hint is wrong
+                self._log.info("Response of %s has more than %d frames, dropping hint",
+                               cmd, hint)
+                del self._response_counts[key]
+            return self.send_command_ex(bytes.fromhex(cmd), cantx, canrx)
+
+        if self._count_hints:
+            if frames <= self.MaxCountHint:
+                if hint is not None and hint != frames:
+                    self._log.info("Response of %s has %d frames instead of %d",
+                                   cmd, frames, hint)
+                self._response_counts[key] = frames
+            else:
+                self._response_counts.pop(key, None)
+
+        if hint is not None:
+            # Without hint the time includes the dongle's timeout
+            self.response_timing(cantx, elapsed, len(ret))
 
-            for line in raw:
-                if ((self._is_extended is False and len(line) != 19)
-                        or (self._is_extended is True and len(line) != 27)):
-                    raise ValueError
+        return data
 
-                offset = 8 if self._is_extended else 3
+    def format_request(self, cmd, cantx, hint):
+        """ Return the line sent for the hex string cmd to cantx. With the
+            number of expected frames appended the dongle returns right
+            after the last frame instead of waiting for its timeout.
+            May be overridden """
+        return cmd if hint is None else cmd + '%X' % hint
+
+    def prepare_request(self, cantx):
+        """ Called before each request to cantx, may be overridden """
+
+    def response_timing(self, cantx, elapsed, length):
+        """ Called with the time and the length of each response,
+            may be overridden """
+
+    def parse_response(self, cmd, ret):
+        """ Reassemble the ISO-TP response ret of the dongle.
+            Returns the data and the number of frames. A complete multi
+            frame response in order, as the dongle prints it nearly
+            always, is checked with a few strided slices over all lines
+            and its hex digits are decoded in one go. Anything else is
+            parsed line by line. """
+        offset = 8 if self._is_extended else 3
+        line_len = offset + 16
+        stride = line_len + 2
+        end = len(ret)
+        lines = (end + 2) // stride
+        try:
+            if (lines > 1 and lines * stride - 2 == end and ret[offset] == 0x31):
+                data_len = (HexDigits[ret[offset+1]] << 8 | HexDigits[ret[offset+2]] << 4 |
+                            HexDigits[ret[offset+3]])
+                # First frame holds 6 bytes, the consecutive ones 7 each
+                if (data_len > 6 and (data_len + 7) // 7 == lines and
+                        ret[line_len::stride] == CR * (lines - 1) and
+                        ret[line_len+1::stride] == LF * (lines - 1) and
+                        ret[offset+stride::stride] == CF * (lines - 1) and
+                        ret[offset+stride+1::stride] == FrameIndexes[:lines-1]):
+                    hex_data = b''.join([ret[offset+4:line_len]] +
+                                        [ret[pos:pos+14] for pos in
+                                         range(offset + stride + 2, end, stride)])
+                    return bytearray(a2b_hex(hex_data[:data_len*2])), lines
+        except (ValueError, KeyError):
+            pass
+
+        return self._parse_lines(cmd, ret)
+
+    def _parse_lines(self, cmd, ret):
+        """ Reassemble the ISO-TP response ret line by line into a buffer
+            of the announced length, see parse_response. """
+        offset = 8 if self._is_extended else 3
+        line_len = offset + 16
+        end = len(ret)
+        view = memoryview(ret)
+        data = None
+        data_len = 0
+        filled = 0
+        last_idx = 0
+        pos = 0
+        try:
+            while True:
+                eol = ret.find(b'\r\n', pos)
+                if eol < 0:
+                    eol = end
+                if eol - pos != line_len:
+                    raise ValueError
 
-                frame_type = int(line[offset:offset+1], 16)
+                pci = pos + offset
+                frame_type = HexDigits[ret[pci]]
 
                 if frame_type == 0:     # Single frame
-                    self._log.debug("%s single frame", line)
-                    data_len = int(line[offset+1:offset+2], 16)
-                    data = bytes.fromhex(line[offset+2:data_len*2+offset+2])
+                    data_len = HexDigits[ret[pci+1]]
+                    data = a2b_hex(view[pci+2:min(pci+2+data_len*2, eol)])
+                    filled = len(data)
                     break
 
                 elif frame_type == 1:   # First frame
-                    self._log.debug("%s first frame", line)
-                    data_len = int(line[offset+1:offset+4], 16)
-                    data = bytearray.fromhex(line[offset+4:])
+                    data_len = (HexDigits[ret[pci+1]] << 8 | HexDigits[ret[pci+2]] << 4 |
+                                HexDigits[ret[pci+3]])
+                    data = bytearray(max(data_len, 6))
+                    data[0:6] = a2b_hex(view[pci+4:eol])
+                    filled = 6
                     last_idx = 0
 
-                elif frame_type == 2:   # Consecutive frame
-                    self._log.debug("%s consecutive frame", line)
-                    idx = int(line[offset+1:offset+2], 16)
+                elif frame_type == 2 and data is not None:   # Consecutive frame
+                    idx = HexDigits[ret[pci+1]]
                     if (last_idx + 1) % 0x10 != idx:
                         raise CanError("Bad frame order: last_idx(%d) idx(%d)" %
                                        (last_idx, idx))
 
-                    frame_len = min(7, data_len - len(data))
-                    data.extend(bytearray.fromhex(
-                        line[offset+2:frame_len*2+offset+2]))
+                    frame_len = min(7, data_len - filled)
+                    if frame_len > 0:
+                        data[filled:filled+frame_len] = a2b_hex(view[pci+2:pci+2+frame_len*2])
+                        filled += frame_len
                     last_idx = idx
 
-                    if data_len == len(data):
+                    if data_len == filled:
                         break
 
                 else:                   # Unexpected frame
                     raise ValueError
 
+                if eol == end:
+                    break
+                pos = eol + 2
+
             if not data or data_len == 0:
                 raise NoData('NO DATA')
 
-            if data_len != len(data):
+            if data_len != filled:
                 raise CanError("Data length mismatch %s: %d vs %d %s" %
-                               (cmd, data_len, len(data), data.hex()))
+                               (cmd, data_len, filled, data[:filled].hex()))
 
-        except ValueError:
+        except (ValueError, KeyError):
             raise CanError("Failed Command %s\n%s" % (cmd, ret))
 
-        return data
+        return data, ret.count(b'\r\n') + 1
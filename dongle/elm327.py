@@ -1,29 +1,57 @@
 """ Module for ELM327 based dongles """
+from collections import deque
+from math import ceil
 from .at_base_dongle import AtBase
 
+# ATST counts in steps of 4.096 ms
+ST_STEP = 0.004096
+# Learned timeouts: margin over the slowest recent response, bounds and
+# rounding (in ATST steps) to avoid resending ATST for small changes
+ST_MARGIN = 3
+ST_MIN = 0x18
+ST_MAX = 0xff
+ST_ROUND = 8
+ST_SAMPLES = 16
+ST_MIN_SAMPLES = 4
+
 
 class Elm327(AtBase):
     """ Implementation for ELM327 """
 
+    # ATBRD derives the speed from 4 MHz, these are within 2.5%
+    Speeds = (38400, 57600, 115200, 230400, 500000)
+
     def __init__(self, dongle):
         AtBase.__init__(self, dongle)
+        self._count_hints = dongle.get('count_hints', True)
+        # Response times per ECU, used to derive its ATST timeout
+        self._response_times = {}
+        self._current_st = ST_MAX
         self._ret_no_data = (b'NO DATA', b'DATA ERROR', b'ACT ALERT')
         self._ret_can_error = (b'BUFFER FULL', B'BUS BUSY', b'BUS ERROR', b'CAN ERROR',
                                b'ERR', b'FB ERROR', b'LP ALERT', b'LV RESET', b'STOPPED',
                                b'UNABLE TO CONNECT')
 
     def init_dongle(self):
-        """ Send some initializing commands to the dongle. """
-        cmds = (('ATZ', 'ELM327'),
+        """ Send some initializing commands to the dongle. ATZ would
+            reset a negotiated serial speed, use ATWS at those. """
+        reset = 'ATZ' if self._serial.baudrate == self._speed else 'ATWS'
+        cmds = ((reset, 'ELM327'),
                 ('ATE0', 'OK'),
                 ('ATL1', 'OK'),
                 ('ATS0', 'OK'),
                 ('ATH1', 'OK'),
+                ('ATAT1', 'OK'),
                 ('ATSTFF', 'OK'),
                 ('ATFE', 'OK'))
 
         for cmd, exp in cmds:
             self.send_at_cmd(cmd, exp)
+        self._current_st = ST_MAX
+
+    def speed_command(self, speed):
+        """ Return the command switching the serial speed """
+        return 'ATBRD%02X' % round(4000000 / speed)
 
     def set_protocol(self, prot):
         """ Set the variant of CAN protocol """
@@ -35,6 +63,29 @@ class Elm327(AtBase):
             self._is_extended = True
         else:
             raise ValueError('Unsupported protocol %s' % prot)
+        self._protocol = prot
+
+    def learned_st(self, cantx):
+        """ Return the timeout of the ECU in ATST steps """
+        times = self._response_times.get(cantx)
+        if times and len(times) >= ST_MIN_SAMPLES:
+            st = ceil(ST_MARGIN * max(times) / ST_STEP / ST_ROUND) * ST_ROUND
+            return min(ST_MAX, max(ST_MIN, st))
+        return ST_MAX
+
+    def prepare_request(self, cantx):
+        """ Set the learned timeout of the ECU """
+        st = self.learned_st(cantx)
+        if st != self._current_st:
+            self.send_at_cmd('ATST%02X' % st)
+            self._current_st = st
+
+    def response_timing(self, cantx, elapsed, length):
+        """ Record the response time of the ECU without the
+            time spent transferring the response to us """
+        transfer = (length + 2) * 10 / self._serial.baudrate
+        self._response_times.setdefault(cantx, deque(maxlen=ST_SAMPLES)).append(
+            max(0, elapsed - transfer))
 
     def set_can_id(self, can_id):
         """ Set CAN id to use for sent frames """
@@ -13,6 +13,14 @@ B220103 = bytes.fromhex('220103')
 B220104 = bytes.fromhex('220104')
 B220105 = bytes.fromhex('220105')
 B22b002 = bytes.fromhex('22b002')
+B222005 = bytes.fromhex('222005')
+B222006 = bytes.fromhex('222006')
+B225017 = bytes.fromhex('225017')
+B229001 = bytes.fromhex('229001')
+B229002 = bytes.fromhex('229002')
+B229006 = bytes.fromhex('229006')
+B229245 = bytes.fromhex('229245')
+B229257 = bytes.fromhex('229257')
 
 data = {
     'IONIQ_BEV': {
@@ -107,7 +115,22 @@ data = {
                                     00000000000000""")[:0x00f],
             },
         },
-
+    'ZOE_ZE50': {
+        0x18dadbf1: {   # LBC
+            B229001: bytes.fromhex('6290012008'),
+            B229002: bytes.fromhex('6290021f40'),
+            B229006: bytes.fromhex('6290060005ce54'),
+            B229245: bytes.fromhex('62924500bc614e'),
+            B229257: bytes.fromhex('6292577c18'),
+            },
+        0x18dadaf1: {   # EVC
+            B222005: bytes.fromhex('6220050578'),
+            B222006: bytes.fromhex('622006005ba0'),
+            },
+        0x18dadef1: {   # BCB
+            B225017: bytes.fromhex('62501700'),
+            },
+        },
     }
 
 class FakeDongle:
@@ -115,6 +138,12 @@ class FakeDongle:
         self._data = data[config['car_type']]
 
     def send_command_ex(self, cmd, cantx, canrx):
+        if cmd not in self._data[cantx] and cmd[0] == 0x22 and len(cmd) > 3:
+            # ReadDataByIdentifier with multiple DIDs
+            resp = bytearray(b'\x62')
+            for idx in range(1, len(cmd), 2):
+                resp.extend(self._data[cantx][b'\x22' + cmd[idx:idx+2]][1:])
+            return bytes(resp)
         return self._data[cantx][cmd]
 
     def set_protocol(self, bla):
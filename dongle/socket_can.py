@@ -1,9 +1,16 @@
 """ Module implementing an interface through Linux's socket CAN interface """
-from time import sleep
-from socket import (socket, timeout as sock_timeout,
-                    AF_CAN, PF_CAN, SOCK_DGRAM, SOCK_RAW, CAN_ISOTP,
-                    CAN_RAW, CAN_EFF_FLAG, CAN_EFF_MASK, CAN_RAW_FILTER,
-                    SOL_CAN_BASE, SOL_CAN_RAW)
+from collections import deque
+from threading import Lock, Condition, Thread
+from time import sleep, monotonic
+from select import poll, POLLIN
+from socket import (socket, timeout as sock_timeout, CMSG_SPACE, MSG_DONTWAIT,
+                    SOL_SOCKET,
+                    AF_CAN, PF_CAN, SOCK_DGRAM, SOCK_RAW, CAN_ISOTP, CAN_BCM,
+                    CAN_BCM_TX_SETUP, CAN_BCM_TX_DELETE, CAN_BCM_RX_SETUP,
+                    CAN_BCM_RX_DELETE, CAN_BCM_RX_CHANGED, CAN_BCM_RX_TIMEOUT,
+                    CAN_BCM_SETTIMER, CAN_BCM_STARTTIMER, CAN_BCM_RX_ANNOUNCE_RESUME,
+                    CAN_RAW, CAN_EFF_FLAG, CAN_EFF_MASK, CAN_SFF_MASK,
+                    CAN_RAW_FILTER, SOL_CAN_BASE, SOL_CAN_RAW)
 from struct import Struct, pack
 import logging
 import sys
@@ -30,7 +37,46 @@ CAN_ISOTP_RX_PADDING = 0x8
 CAN_ISOTP_CHK_PAD_LEN = 0x10
 CAN_ISOTP_CHK_PAD_DATA = 0x20
 
+# Not exported by the socket module
+SO_TIMESTAMP = 29
+
 CANFMT = Struct("<IB3x8s")
+CANHDR = Struct("<IB")
+# struct bcm_msg_head: opcode, flags, count, ival1, ival2, can_id, nframes
+# followed by the 8 byte aligned frames
+BCMHDR = Struct("@3I4l2I0q")
+TIMEVAL = Struct("@2l")
+
+# Number of frames read_raw_frames receives per call at most
+RAW_BATCH = 64
+
+TXQLEN = 4000
+
+# CAN controller states that need a restart, as decoded by pyroute2 or raw.
+# Not every driver reports a state, those links are left alone.
+CAN_STATES_FAILED = ('ERROR_PASSIVE', 'BUS_OFF', 2, 3)
+
+FLOW_CONTROL = b'\x30\x00\x00\x00\x00\x00\x00\x00'
+
+# Adaptive timeouts: weight of a new sample in the EWMA, the number of
+# samples kept for the percentile and the factors applied to both
+LATENCY_ALPHA = 0.2
+LATENCY_SAMPLES = 32
+LATENCY_PERCENTILE = 0.95
+PERCENTILE_FACTOR = 2
+EWMA_FACTOR = 4
+# The timeout is only lowered once this many latencies were recorded
+LATENCY_MIN_SAMPLES = 8
+# Timeouts are rounded up to this granularity to avoid resetting the
+# socket timeout on every command
+TIMEOUT_STEP = 0.005
+
+# Broadcast manager: an ECU that did not answer any of its cyclic
+# requests for this many cycles is considered asleep
+BCM_RX_TIMEOUT_CYCLES = 3
+# Gap in seconds between the requests a job sends right after its setup,
+# before it continues at its interval
+BCM_BURST_GAP = 0.01
 
 
 def can_str(msg):
@@ -90,6 +136,213 @@ class CanSocket(socket):
         self.setsockopt(SOL_CAN_RAW, CAN_RAW_FILTER, bin_filter)
 
 
+class LatencyStats:
+    """ Running response latency statistics of one ECU. The timeout is
+        derived from an EWMA and a high percentile of the recent latencies
+        and kept within [timeout_min, timeout_max]. It is only lowered
+        after LATENCY_MIN_SAMPLES responses. A response arriving after the
+        timeout widens it. """
+    __slots__ = ('ewma', 'samples', 'count', 'timeouts', 'late',
+                 'timeout', 'timeout_min', 'timeout_max')
+
+    def __init__(self, timeout, timeout_min, timeout_max):
+        self.ewma = None
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.count = 0
+        self.timeouts = 0
+        self.late = 0
+        self.timeout = timeout
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+
+    def percentile(self):
+        """ Return the high percentile of the recent latencies """
+        samples = sorted(self.samples)
+        return samples[int(LATENCY_PERCENTILE * (len(samples) - 1))]
+
+    def add(self, latency):
+        """ Record the latency of a response and update the timeout """
+        self.count += 1
+        self.samples.append(latency)
+        if self.ewma is None:
+            self.ewma = latency
+        else:
+            self.ewma += LATENCY_ALPHA * (latency - self.ewma)
+
+        timeout = max(PERCENTILE_FACTOR * self.percentile(),
+                      EWMA_FACTOR * self.ewma)
+        timeout = TIMEOUT_STEP * -(-timeout // TIMEOUT_STEP)
+        if self.count < LATENCY_MIN_SAMPLES:
+            timeout = max(timeout, self.timeout)
+        self.timeout = min(self.timeout_max, max(self.timeout_min, timeout))
+
+    def add_timeout(self):
+        """ Record a request without response """
+        self.timeouts += 1
+
+    def add_late(self):
+        """ Record a response that arrived after the timeout. Its latency
+            is unknown, so count it as twice the timeout. """
+        self.late += 1
+        self.add(2 * self.timeout)
+
+    def as_dict(self):
+        """ Return the statistics in ms for monitoring """
+        return {
+            'count': self.count,
+            'timeouts': self.timeouts,
+            'late': self.late,
+            'ewma': None if self.ewma is None else self.ewma * 1000,
+            'p%d' % (LATENCY_PERCENTILE * 100):
+                self.percentile() * 1000 if self.samples else None,
+            'timeout': self.timeout * 1000,
+            }
+
+
+class IsoTpTransfer:
+    """ State of one ISO-TP transfer handled by IsoTpEngine """
+    __slots__ = ('cantx', 'data', 'data_len', 'last_idx', 'done', 'error')
+
+    def __init__(self, cantx):
+        self.cantx = cantx
+        self.data = None
+        self.data_len = 0
+        self.last_idx = 0
+        self.done = False
+        self.error = None
+
+
+class IsoTpEngine:
+    """ Userspace ISO-TP on one long lived raw socket. Frames are received
+        into a preallocated buffer and demultiplexed by CAN id, so transfers
+        to different ECUs can be outstanding at the same time. Whichever
+        waiting thread currently reads the socket dispatches the frames
+        for all transfers. """
+
+    def __init__(self, sock):
+        self._log = logging.getLogger("EVNotiPi/SocketCAN/ISO-TP")
+        self._sock = sock
+        self._buf = bytearray(CANFMT.size)
+        self._view = memoryview(self._buf)
+        self._transfers = {}
+        self._filters = set()
+        self._cond = Condition(Lock())
+        self._reading = False
+        # CAN ids that sent frames while no transfer was waiting for them
+        self.late = set()
+
+    def close(self):
+        """ Close the socket """
+        self._sock.close()
+
+    def _add_filter(self, canrx):
+        """ Let frames of canrx pass the socket filter """
+        if canrx & CAN_EFF_FLAG:
+            mask = CAN_EFF_FLAG | CAN_EFF_MASK
+        else:
+            mask = CAN_EFF_FLAG | CAN_SFF_MASK
+        self._filters.add((canrx, mask))
+        self._sock.set_filters_ex([{'id': can_id, 'mask': mask}
+                                   for can_id, mask in self._filters])
+
+    def transfer(self, cmd, cantx, canrx, timeout):
+        """ Send single frame request cmd to cantx and return the
+            reassembled response from canrx """
+        cmd_len = len(cmd)
+        if cmd_len > 7:
+            raise CanError("Command too long for single frame %s" % cmd.hex())
+
+        xfer = IsoTpTransfer(cantx)
+        with self._cond:
+            if canrx in self._transfers:
+                raise CanError("Transfer on %x already in progress" % canrx)
+            if canrx not in {can_id for can_id, _ in self._filters}:
+                self._add_filter(canrx)
+            self._transfers[canrx] = xfer
+
+        try:
+            msg_data = (bytes([cmd_len]) + cmd).ljust(8, b'\x00')
+            cmd_msg = CANFMT.pack(cantx, len(msg_data), msg_data)
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("%s send messsage", can_str(cmd_msg))
+            self._sock.send(cmd_msg)
+
+            deadline = monotonic() + timeout
+            while not xfer.done:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise NoData("Command timed out %s" % cmd.hex())
+
+                with self._cond:
+                    if self._reading:
+                        # Another thread reads, it dispatches our frames
+                        self._cond.wait(remaining)
+                        continue
+                    self._reading = True
+
+                try:
+                    self._receive(remaining)
+                finally:
+                    with self._cond:
+                        self._reading = False
+                        self._cond.notify_all()
+        finally:
+            with self._cond:
+                del self._transfers[canrx]
+
+        if xfer.error:
+            raise xfer.error
+
+        return xfer.data
+
+    def _receive(self, timeout):
+        """ Receive one frame and feed it into its transfer """
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.recv_into(self._buf)
+        except sock_timeout:
+            return
+
+        can_id, length = CANHDR.unpack_from(self._buf)
+        xfer = self._transfers.get(can_id)
+        if xfer is None:
+            self.late.add(can_id)
+            return
+        if xfer.done:
+            return
+
+        msg_data = self._view[8:8 + length]
+        frame_type = msg_data[0] & 0xf0
+
+        if frame_type == 0x00:      # Single frame
+            xfer.data_len = msg_data[0] & 0x0f
+            xfer.data = bytes(msg_data[1:xfer.data_len + 1])
+            xfer.done = True
+
+        elif frame_type == 0x10:    # First frame
+            xfer.data_len = (msg_data[0] & 0x0f) << 8 | msg_data[1]
+            xfer.data = bytearray(msg_data[2:])
+            xfer.last_idx = 0
+            self._sock.send(CANFMT.pack(xfer.cantx, 8, FLOW_CONTROL))
+
+        elif frame_type == 0x20 and xfer.data is not None:   # Consecutive frame
+            idx = msg_data[0] & 0x0f
+            if (xfer.last_idx + 1) % 0x10 != idx:
+                xfer.error = CanError("Bad frame order: last_idx(%d) idx(%d)" %
+                                      (xfer.last_idx, idx))
+                xfer.done = True
+                return
+
+            frame_len = min(7, xfer.data_len - len(xfer.data))
+            xfer.data.extend(msg_data[1:frame_len + 1])
+            xfer.last_idx = idx
+            xfer.done = len(xfer.data) == xfer.data_len
+
+        else:
+            xfer.error = CanError("Unexpected message: %s" % (can_str(self._buf)))
+            xfer.done = True
+
+
 class SocketCan:
     """ Socket CAN interface """
 
@@ -101,21 +354,52 @@ class SocketCan:
 
         self._is_extended = False
 
+        # Requests to different ECUs are independent and may overlap
+        self.concurrent_ecus = config.get('concurrent', True)
+
+        # Pool of bound ISO-TP sockets keyed by (canrx, cantx, extended)
+        self._isotp_socks = {}
+        self._isotp_socks_lock = Lock()
+        # Sockets that timed out, a late response may still arrive
+        self._isotp_stale = set()
+
+        # Response latency statistics keyed by (cantx, canrx)
+        self._latency = {}
+        self._timeout = config.get('timeout', 0.2)
+        self._timeout_min = config.get('timeout_min', 0.1)
+        self._timeout_max = config.get('timeout_max', 0.5)
+
+        # Cyclic single frame requests handled by the broadcast manager.
+        # Jobs are keyed by (cantx, canrx), the latest responses by
+        # (canrx, cmd). The kernel keeps one TX job per CAN id and socket,
+        # so every interval has its own TX socket. ECUs whose TX jobs run
+        # are kept in _bcm_armed, those to set up again with the next
+        # request after suspend_cyclic in _bcm_suspended.
+        self._bcm = config.get('bcm', False)
+        self._bcm_interval = config.get('bcm_interval', 1)
+        self._bcm_sock = None
+        self._bcm_tx_socks = {}
+        self._bcm_jobs = {}
+        self._bcm_cmds = {}
+        self._bcm_mux = {}
+        self._bcm_responses = {}
+        self._bcm_armed = set()
+        self._bcm_suspended = set()
+        self._bcm_cond = Condition(Lock())
+
+        self._can_raw_sock = None
+        self._can_raw_poll = None
+        self._can_raw_timestamps = False
+        # Frames received by read_raw_frames, reused by every call
+        self._can_raw_buf = memoryview(bytearray(RAW_BATCH * CANFMT.size))
+        self._isotp_engine = None
+
         self.init_dongle()
 
     def init_dongle(self):
         """ Set up the network interface and initialize socket """
-        ip_route = IPRoute()
-        ifidx = ip_route.link_lookup(ifname=self._config['port'])[0]
-        link = ip_route.link('get', index=ifidx)
-        if 'state' in link[0] and link[0]['state'] == 'up':
-            ip_route.link('set', index=ifidx, state='down')
-            sleep(1)
-
-        ip_route.link('set', index=ifidx, type='can',
-                      txqlen=4000, bitrate=self._config['speed'])
-        ip_route.link('set', index=ifidx, state='up')
-        ip_route.close()
+        self.close_sockets()
+        self.setup_link()
 
         # test if kernel supports CAN_ISOTP
         try:
@@ -131,12 +415,377 @@ class SocketCan:
         except OSError as err:
             if err.errno == 93:
                 # CAN_ISOTP not supported
+                sock = CanSocket(PF_CAN, SOCK_RAW, CAN_RAW)
+                sock.bind((self._config['port'],))
+                self._isotp_engine = IsoTpEngine(sock)
                 self.send_command_ex = self.send_command_ex_canraw
+                self._log.info("using userspace ISO-TP")
             else:
                 raise
 
+        if self._bcm:
+            self._send_command_ex_direct = self.send_command_ex
+            self.send_command_ex = self.send_command_ex_bcm
+            if self._bcm_jobs:
+                self._setup_bcm()
+
         self._can_raw_sock = CanSocket(PF_CAN, SOCK_RAW, CAN_RAW)
         self._can_raw_sock.bind((self._config['port'],))
+        self._can_raw_poll = poll()
+        self._can_raw_poll.register(self._can_raw_sock, POLLIN)
+        self._can_raw_timestamps = False
+
+    def setup_link(self):
+        """ Configure bitrate and bring up the network interface.
+            Only touch the link if its configuration differs or the
+            controller reports ERROR-PASSIVE or BUS-OFF. """
+        ip_route = IPRoute()
+        try:
+            ifidx = ip_route.link_lookup(ifname=self._config['port'])[0]
+            link = ip_route.link('get', index=ifidx)[0]
+            is_up = link.get('state') == 'up'
+
+            link_info = link.get_attr('IFLA_LINKINFO')
+            kind = link_info.get_attr('IFLA_INFO_KIND') if link_info else None
+            if kind != 'can':
+                # Virtual interfaces like vcan have no bitrate
+                self._log.info("%s is a %s link, not configuring bitrate",
+                               self._config['port'], kind)
+                if not is_up:
+                    ip_route.link('set', index=ifidx, state='up')
+                return
+
+            bitrate = None
+            state = None
+            info_data = link_info.get_attr('IFLA_INFO_DATA')
+            if info_data:
+                bittiming = info_data.get_attr('IFLA_CAN_BITTIMING')
+                if bittiming:
+                    bitrate = bittiming['bitrate']
+                state = info_data.get_attr('IFLA_CAN_STATE')
+
+            if is_up and state in CAN_STATES_FAILED:
+                self._log.warning("%s is in state %s, restarting", self._config['port'], state)
+            elif (bitrate == self._config['speed'] and
+                  link.get_attr('IFLA_TXQLEN') == TXQLEN):
+                self._log.info("%s already configured", self._config['port'])
+                if not is_up:
+                    ip_route.link('set', index=ifidx, state='up')
+                return
+
+            if is_up:
+                ip_route.link('set', index=ifidx, state='down')
+                sleep(1)
+
+            ip_route.link('set', index=ifidx, type='can',
+                          txqlen=TXQLEN, bitrate=self._config['speed'])
+            ip_route.link('set', index=ifidx, state='up')
+        finally:
+            ip_route.close()
+
+    def close_sockets(self):
+        """ Close the pooled ISO-TP sockets, the userspace ISO-TP engine
+            and the raw socket """
+        with self._isotp_socks_lock:
+            for sock in self._isotp_socks.values():
+                sock.close()
+            self._isotp_socks.clear()
+            self._isotp_stale.clear()
+
+        if self._bcm_sock is not None:
+            # The reader thread keeps the socket alive, stop the jobs first
+            for ecu in self._bcm_jobs:
+                self._bcm_disarm(ecu)
+                _, canrx = self._bcm_can_ids(*ecu)
+                try:
+                    self._bcm_sock.send(BCMHDR.pack(CAN_BCM_RX_DELETE, 0, 0, 0, 0, 0, 0,
+                                                    canrx, 0))
+                except OSError:
+                    pass
+            self._bcm_sock.close()
+            self._bcm_sock = None
+            for sock in self._bcm_tx_socks.values():
+                sock.close()
+            self._bcm_tx_socks.clear()
+
+        if self._isotp_engine is not None:
+            self._isotp_engine.close()
+            self._isotp_engine = None
+
+        if self._can_raw_sock is not None:
+            self._can_raw_sock.close()
+            self._can_raw_sock = None
+
+    def _bcm_can_ids(self, cantx, canrx):
+        """ Return the CAN ids with the flags of the current protocol """
+        if self._is_extended:
+            return cantx | CAN_EFF_FLAG, canrx | CAN_EFF_FLAG
+        return cantx, canrx
+
+    def register_cyclic(self, requests):
+        """ Let the broadcast manager send single frame requests
+            cyclically. requests is a list of dicts with cmd, cantx, canrx
+            and interval in seconds (0: every bcm_interval). The requests
+            to one ECU need the same length, those with the same interval
+            share one job. Returns the set of registered (cmd, cantx, canrx). """
+        if not self._bcm:
+            return set()
+
+        ecus = {}
+        for request in requests:
+            cmds = ecus.setdefault((request['cantx'], request['canrx']), {})
+            interval = request['interval'] or self._bcm_interval
+            cmds[request['cmd']] = min(cmds.get(request['cmd'], interval), interval)
+
+        registered = set()
+        for (cantx, canrx), cmds in ecus.items():
+            if len({len(cmd) for cmd in cmds}) != 1 or len(next(iter(cmds))) > 7:
+                self._log.info("Not registering cyclic requests to %x, "
+                               "commands differ in length", cantx)
+                continue
+
+            tx_jobs = {}
+            for cmd, interval in cmds.items():
+                tx_jobs.setdefault(interval, []).append(cmd)
+            job = {'cmds': tuple(cmds), 'interval': min(tx_jobs),
+                   'tx': {interval: tuple(tx_cmds) for interval, tx_cmds in tx_jobs.items()}}
+            self._bcm_jobs[(cantx, canrx)] = job
+            for tx_cmds in job['tx'].values():
+                for cmd in tx_cmds:
+                    # The job sends all its requests right after the setup
+                    self._bcm_cmds[(canrx, cmd)] = (len(tx_cmds) * BCM_BURST_GAP +
+                                                    self._timeout_max)
+                    registered.add((cmd, cantx, canrx))
+            self._log.info("Registered %d cyclic requests to %x every %s s",
+                           len(cmds), cantx, '/'.join('%g' % interval
+                                                      for interval in sorted(job['tx'])))
+
+        if registered:
+            self._setup_bcm()
+
+        return registered
+
+    def _setup_bcm(self):
+        """ Set up the broadcast manager jobs of all ECUs """
+        if self._bcm_sock is None:
+            self._bcm_sock = socket(PF_CAN, SOCK_DGRAM, CAN_BCM)
+            self._bcm_sock.connect((self._config['port'],))
+            Thread(target=self._bcm_reader, args=(self._bcm_sock,),
+                   name="EVNotiPi/SocketCAN-BCM", daemon=True).start()
+
+        self._bcm_armed.clear()
+        self._bcm_suspended.clear()
+        for ecu in self._bcm_jobs:
+            self._bcm_arm(ecu)
+
+    def _bcm_tx_socket(self, interval):
+        """ Return the socket for the TX jobs of interval """
+        sock = self._bcm_tx_socks.get(interval)
+        if sock is None:
+            sock = socket(PF_CAN, SOCK_DGRAM, CAN_BCM)
+            sock.connect((self._config['port'],))
+            self._bcm_tx_socks[interval] = sock
+        return sock
+
+    def _bcm_arm(self, ecu):
+        """ Set up the jobs of one ECU. One RX job multiplexes the
+            responses by service and identifier and only reports changed
+            responses, or the ECU timing out. Its timeout starts right
+            away, so an ECU that does not answer is detected. Every TX job
+            sends its requests once in a burst, then round robin spread
+            over its interval. """
+        job = self._bcm_jobs[ecu]
+        cmds = job['cmds']
+        cantx, canrx = self._bcm_can_ids(*ecu)
+
+        # The first frame masks the multiplex bytes: single frame type
+        # and the positive response echoing service and identifier.
+        # In the following frames the other bits mark the data that is
+        # checked for changes. Setting the frames up again clears the
+        # last received data, so the next responses are all reported.
+        mux_len = len(cmds[0])
+        ival1 = job['interval'] * BCM_RX_TIMEOUT_CYCLES
+        msg = bytearray(BCMHDR.pack(CAN_BCM_RX_SETUP,
+                                    CAN_BCM_SETTIMER | CAN_BCM_STARTTIMER |
+                                    CAN_BCM_RX_ANNOUNCE_RESUME, 0,
+                                    int(ival1), int(ival1 % 1 * 1e6), 0, 0,
+                                    canrx, len(cmds) + 1))
+        msg += CANFMT.pack(canrx, 8, (b'\xf0' + b'\xff' * mux_len).ljust(8, b'\x00'))
+        mux = {}
+        for cmd in cmds:
+            prefix = bytes([cmd[0] | 0x40]) + cmd[1:]
+            mux[prefix] = cmd
+            msg += CANFMT.pack(canrx, 8, (b'\x0f' + prefix).ljust(8, b'\xff'))
+        self._bcm_mux[canrx & CAN_EFF_MASK] = mux
+        self._bcm_sock.send(msg)
+
+        for interval, tx_cmds in job['tx'].items():
+            ival2 = interval / len(tx_cmds)
+            msg = bytearray(BCMHDR.pack(CAN_BCM_TX_SETUP,
+                                        CAN_BCM_SETTIMER | CAN_BCM_STARTTIMER, len(tx_cmds),
+                                        0, int(BCM_BURST_GAP * 1e6),
+                                        int(ival2), int(ival2 % 1 * 1e6),
+                                        cantx, len(tx_cmds)))
+            for cmd in tx_cmds:
+                msg += CANFMT.pack(cantx, 8, (bytes([len(cmd)]) + cmd).ljust(8, b'\xaa'))
+            self._bcm_tx_socket(interval).send(msg)
+
+        self._bcm_armed.add(ecu)
+
+    def _bcm_disarm(self, ecu):
+        """ Stop sending the requests to one ECU, so they do not keep it
+            awake, and forget its responses """
+        if ecu not in self._bcm_armed:
+            return
+        cantx, canrx = self._bcm_can_ids(*ecu)
+        for interval in self._bcm_jobs[ecu]['tx']:
+            try:
+                self._bcm_tx_socket(interval).send(
+                    BCMHDR.pack(CAN_BCM_TX_DELETE, 0, 0, 0, 0, 0, 0, cantx, 0))
+            except OSError:
+                pass
+        for cmd in self._bcm_jobs[ecu]['cmds']:
+            self._bcm_responses.pop((canrx & CAN_EFF_MASK, cmd), None)
+        self._bcm_armed.discard(ecu)
+
+    def suspend_cyclic(self):
+        """ Stop all cyclic requests while polling is suspended. The next
+            request to an ECU sets its jobs up again. """
+        with self._bcm_cond:
+            if self._bcm_sock is None:
+                return
+            for ecu in self._bcm_jobs:
+                self._bcm_disarm(ecu)
+                self._bcm_suspended.add(ecu)
+            self._bcm_cond.notify_all()
+
+    def _bcm_reader(self, sock):
+        """ Receive the notifications of the broadcast manager and keep
+            the latest response of every cyclic request """
+        buf = bytearray(BCMHDR.size + CANFMT.size)
+        while True:
+            try:
+                sock.recv_into(buf)
+            except OSError:
+                return
+
+            opcode, _, _, _, _, _, _, canrx, _ = BCMHDR.unpack_from(buf)
+            canrx &= CAN_EFF_MASK
+            with self._bcm_cond:
+                if opcode == CAN_BCM_RX_CHANGED:
+                    _, _, msg_data = CANFMT.unpack_from(buf, BCMHDR.size)
+                    response = msg_data[1:(msg_data[0] & 0x0f) + 1]
+                    mux = self._bcm_mux.get(canrx, {})
+                    for prefix, cmd in mux.items():
+                        if response.startswith(prefix):
+                            self._bcm_responses[(canrx, cmd)] = response
+                            break
+                elif opcode == CAN_BCM_RX_TIMEOUT:
+                    for ecu in self._bcm_jobs:
+                        if ecu[1] == canrx and ecu in self._bcm_armed:
+                            self._log.info("ECU %x stopped answering cyclic requests", canrx)
+                            self._bcm_disarm(ecu)
+                self._bcm_cond.notify_all()
+
+    def send_command_ex_bcm(self, cmd, cantx, canrx):
+        """ Return the latest response of a cyclic request,
+            send other commands directly. Requests to an ECU that
+            stopped answering are sent directly as well, until it
+            answers and its jobs are set up again. """
+        wait = self._bcm_cmds.get((canrx, cmd))
+        if wait is None:
+            return self._send_command_ex_direct(cmd, cantx, canrx)
+
+        ecu = (cantx, canrx)
+        key = (canrx, cmd)
+        with self._bcm_cond:
+            if ecu in self._bcm_suspended:
+                # Polling resumed, set the jobs up once
+                self._log.info("Resuming cyclic requests to %x", cantx)
+                self._bcm_suspended.discard(ecu)
+                self._bcm_arm(ecu)
+            armed = ecu in self._bcm_armed
+            if armed:
+                if key not in self._bcm_responses:
+                    # No response since the jobs were set up
+                    self._bcm_cond.wait_for(lambda: (key in self._bcm_responses or
+                                                     ecu not in self._bcm_armed), wait)
+                response = self._bcm_responses.get(key)
+
+        if not armed:
+            response = self._send_command_ex_direct(cmd, cantx, canrx)
+            with self._bcm_cond:
+                if ecu not in self._bcm_armed and ecu not in self._bcm_suspended:
+                    self._log.info("ECU %x answers again, resuming cyclic requests", cantx)
+                    # The responses of the jobs would queue up on the
+                    # pooled socket of the ECU
+                    bcm_cantx, bcm_canrx = self._bcm_can_ids(cantx, canrx)
+                    self._drop_isotp_socket((bcm_canrx, bcm_cantx, self._is_extended))
+                    self._bcm_arm(ecu)
+            return response
+
+        if response is None:
+            raise NoData('NO DATA')
+
+        return response
+
+    def _get_latency_stats(self, cantx, canrx):
+        """ Return the latency statistics of an ECU, create them if necessary """
+        stats = self._latency.get((cantx, canrx))
+        if stats is None:
+            stats = LatencyStats(self._timeout, self._timeout_min, self._timeout_max)
+            self._latency[(cantx, canrx)] = stats
+        return stats
+
+    def get_latency_stats(self):
+        """ Return the response latency statistics per ECU """
+        return {'%x:%x' % key: stats.as_dict()
+                for key, stats in self._latency.items()}
+
+    def _get_isotp_socket(self, key, stats):
+        """ Return the bound ISO-TP socket for key (canrx, cantx, extended)
+            from the pool, create it if necessary. Drain responses that
+            arrived late after a timeout and record them in stats. """
+        sock = self._isotp_socks.get(key)
+        if sock is None:
+            canrx, cantx, _ = key
+            sock = CanSocket(AF_CAN, SOCK_DGRAM, CAN_ISOTP)
+            try:
+                sock.setsockopt(SOL_CAN_ISOTP, CAN_ISOTP_OPTS,
+                                self._sock_opt_isotp_opt)
+                sock.setsockopt(SOL_CAN_ISOTP, CAN_ISOTP_RECV_FC,
+                                self._sock_opt_isotp_fc)
+                sock.bind((self._config['port'], canrx, cantx))
+            except OSError:
+                sock.close()
+                raise
+
+            with self._isotp_socks_lock:
+                self._isotp_socks[key] = sock
+
+        elif key in self._isotp_stale:
+            self._isotp_stale.discard(key)
+            sock.settimeout(0)
+            try:
+                while True:
+                    stale = sock.recv(4096)
+                    self._log.debug("Drop stale response %s", stale.hex())
+                    stats.add_late()
+            except (BlockingIOError, sock_timeout):
+                pass
+
+        if sock.gettimeout() != stats.timeout:
+            sock.settimeout(stats.timeout)
+
+        return sock
+
+    def _drop_isotp_socket(self, key):
+        """ Remove a socket from the pool after an error """
+        with self._isotp_socks_lock:
+            sock = self._isotp_socks.pop(key, None)
+            self._isotp_stale.discard(key)
+        if sock is not None:
+            sock.close()
 
     def send_command_ex_isotp(self, cmd, cantx, canrx):
         """ Send a command using specified can tx id and
@@ -146,30 +795,32 @@ class SocketCan:
             self._log.debug("sendCommandEx_ISOTP cmd(%s) cantx(%x) canrx(%x)",
                             cmd.hex(), canrx, cantx)
 
+        stats = self._get_latency_stats(cantx, canrx)
+
         if self._is_extended:
             cantx |= CAN_EFF_FLAG
             canrx |= CAN_EFF_FLAG
 
+        key = (canrx, cantx, self._is_extended)
         try:
-            with CanSocket(AF_CAN, SOCK_DGRAM, CAN_ISOTP) as sock:
-                sock.setsockopt(SOL_CAN_ISOTP, CAN_ISOTP_OPTS,
-                                self._sock_opt_isotp_opt)
-                sock.setsockopt(SOL_CAN_ISOTP, CAN_ISOTP_RECV_FC,
-                                self._sock_opt_isotp_fc)
+            sock = self._get_isotp_socket(key, stats)
 
-                sock.bind((self._config['port'], canrx, cantx))
-                sock.settimeout(0.2)
-
-                if self._log.isEnabledFor(logging.DEBUG):
-                    self._log.debug("canrx(%s) cantx(%s) cmd(%s)",
-                                    hex(canrx), hex(cantx), cmd.hex())
-                sock.send(cmd)
-                data = sock.recv(4096)
-                if self._log.isEnabledFor(logging.DEBUG):
-                    self._log.debug(data.hex())
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("canrx(%s) cantx(%s) cmd(%s)",
+                                hex(canrx), hex(cantx), cmd.hex())
+            start = monotonic()
+            sock.send(cmd)
+            data = sock.recv(4096)
+            stats.add(monotonic() - start)
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug(data.hex())
         except sock_timeout as err:
+            stats.add_timeout()
+            self._isotp_stale.add(key)
             raise NoData("Command timed out %s: %s" % (cmd.hex(), err))
         except OSError as err:
+            # Rebuild the socket on the next command
+            self._drop_isotp_socket(key)
             raise CanError("Failed Command %s: %s" % (cmd.hex(), err))
 
         if not data or len(data) == 0:
@@ -179,109 +830,35 @@ class SocketCan:
 
     def send_command_ex_canraw(self, cmd, cantx, canrx):
         """ Send a command using specified can tx id and
-            return response from can rx id. """
+            return response from can rx id.
+            Implemented using the userspace ISO-TP engine. """
         if self._log.isEnabledFor(logging.DEBUG):
             self._log.debug("sendCommandEx_CANRAW cmd(%s) cantx(%x) canrx(%x)",
                             cmd.hex(), canrx, cantx)
 
+        stats = self._get_latency_stats(cantx, canrx)
+
         if self._is_extended:
             cantx |= CAN_EFF_FLAG
             canrx |= CAN_EFF_FLAG
 
-        try:
-            cmd_len = len(cmd)
-            assert cmd_len < 8
-
-            msg_data = (bytes([cmd_len]) + cmd).ljust(8, b'\x00')  # Pad cmd to 8 bytes
-
-            cmd_msg = CANFMT.pack(cantx, len(msg_data), msg_data)
-
-            if self._log.isEnabledFor(logging.DEBUG):
-                self._log.debug("%s send messsage", can_str(cmd_msg))
-
-            with CanSocket(PF_CAN, SOCK_RAW, CAN_RAW) as sock:
-                sock.bind((self._config['port'],))
-                sock.settimeout(0.2)
-
-                sock.set_filters_ex([{
-                    'id':   canrx,
-                    'mask': 0x1fffffff if self._is_extended else 0x7ff
-                    }])
-
-                sock.send(cmd_msg)
-
-                data = None
-                data_len = 0
-                last_idx = 0
-
-                while True:
-                    self._log.debug("waiting recv msg")
-                    msg = sock.recv(72)
-                    can_id, length, msg_data = CANFMT.unpack(msg)
-
-                    if self._log.isEnabledFor(logging.DEBUG):
-                        self._log.debug("Got %x %i %s", can_id,
-                                        length, msg_data.hex())
-
-                    can_id &= CAN_EFF_MASK
-                    msg_data = msg_data[:length]
-                    frame_type = msg_data[0] & 0xf0
-
-                    if frame_type == 0x00:
-                        if self._log.isEnabledFor(logging.DEBUG):
-                            self._log.debug("%s single frame", can_str(msg))
-
-                        data_len = msg_data[0] & 0x0f
-                        data = bytes(msg_data[1:data_len+1])
-
-                    elif frame_type == 0x10:
-                        if self._log.isEnabledFor(logging.DEBUG):
-                            self._log.debug("%s first frame", can_str(msg))
-
-                        data_len = (msg_data[0] & 0x0f) + msg_data[1]
-                        data = bytearray(msg_data[2:])
+        engine = self._isotp_engine
+        if canrx in engine.late:
+            engine.late.discard(canrx)
+            stats.add_late()
 
-                        if self._log.isEnabledFor(logging.DEBUG):
-                            self._log.debug("Send flow control message")
-
-                        flow_msg = CANFMT.pack(cantx, 8, b'\x30\x00\x00\x00\x00\x00\x00\x00')
-
-                        sock.send(flow_msg)
-
-                        last_idx = 0
-
-                    elif frame_type == 0x20:
-                        if self._log.isEnabledFor(logging.DEBUG):
-                            self._log.debug("%s consecutive frame", can_str(msg))
-
-                        idx = msg_data[0] & 0x0f
-                        if (last_idx + 1) % 0x10 != idx:
-                            raise CanError("Bad frame order: last_idx(%d) idx(%d)" %
-                                           (last_idx, idx))
-
-                        frame_len = min(7, data_len - len(data))
-                        data.extend(msg_data[1:frame_len+1])
-                        last_idx = idx
-
-                        if data_len == len(data):
-                            # All frames seen, exit loop
-                            break
-
-                    elif frame_type == 0x30:
-                        raise CanError("Unexpected flow control: %s" % (can_str(msg)))
-                    else:
-                        raise CanError("Unexpected message: %s" % (can_str(msg)))
-
-        except sock_timeout as err:
-            raise NoData("Command timed out %s: %s" % (cmd.hex(), err))
+        try:
+            start = monotonic()
+            data = engine.transfer(cmd, cantx, canrx, stats.timeout)
+            stats.add(monotonic() - start)
+        except NoData:
+            stats.add_timeout()
+            raise
         except OSError as err:
             raise CanError("Failed Command %s: %s" % (cmd.hex(), err))
 
-        if not data or data_len == 0:
+        if not data:
             raise NoData('NO DATA')
-        if data_len != len(data):
-            raise CanError("Data length mismatch %s: %d vs %d %s" %
-                           (cmd.hex(), data_len, len(data), data.hex()))
 
         return data
 
@@ -311,6 +888,55 @@ class SocketCan:
         except OSError as err:
             raise CanError("CAN read error: %s" % (err))
 
+    def read_raw_frames(self, timeout=None, timestamps=False):
+        """ Read all pending frames, waiting up to timeout seconds for
+            the first one. Returns a list of (can_id, data) tuples, or
+            (can_id, data, timestamp) with the kernel's receive time if
+            timestamps is set. data is a memoryview into a buffer which
+            is reused by the next call. """
+        sock = self._can_raw_sock
+        if sock.gettimeout() is not None:
+            # Waiting is done by poll, MSG_DONTWAIT needs a blocking socket
+            sock.settimeout(None)
+        if timestamps and not self._can_raw_timestamps:
+            sock.setsockopt(SOL_SOCKET, SO_TIMESTAMP, 1)
+            self._can_raw_timestamps = True
+
+        try:
+            if timeout is not None and not self._can_raw_poll.poll(timeout * 1000):
+                return []
+
+            frames = []
+            flags = 0
+            size = CANFMT.size
+            for pos in range(0, len(self._can_raw_buf), size):
+                frame = self._can_raw_buf[pos:pos + size]
+                if timestamps:
+                    _, ancdata, _, _ = sock.recvmsg_into((frame,), CMSG_SPACE(TIMEVAL.size),
+                                                         flags)
+                    stamp = None
+                    for level, kind, cdata in ancdata:
+                        if level == SOL_SOCKET and kind == SO_TIMESTAMP:
+                            sec, usec = TIMEVAL.unpack_from(cdata)
+                            stamp = sec + usec * 1e-6
+                else:
+                    sock.recv_into(frame, size, flags)
+
+                can_id, length = CANHDR.unpack_from(frame)
+                if timestamps:
+                    frames.append((can_id & CAN_EFF_MASK, frame[8:8 + length], stamp))
+                else:
+                    frames.append((can_id & CAN_EFF_MASK, frame[8:8 + length]))
+                # Only drain what is already queued
+                flags = MSG_DONTWAIT
+
+        except BlockingIOError:
+            pass
+        except OSError as err:
+            raise CanError("CAN read error: %s" % (err))
+
+        return frames
+
     def set_raw_mask(self, mask):
         """ Set the can receive mask of the raw socket"""
         self._can_raw_sock.set_can_rx_mask(mask)
@@ -324,12 +950,11 @@ class SocketCan:
         self._can_raw_sock.set_filters_ex(filters)
 
     def set_protocol(self, prot):
-        """ select the CAN flavor """
+        """ select the CAN flavor. Only the CAN id format of the
+            requests changes, the link is left alone. """
         if prot == 'CAN_11_500':
             self._is_extended = False
         elif prot == 'CAN_29_500':
             self._is_extended = True
         else:
             raise ValueError('Unsupported protocol %s' % prot)
-
-        self.init_dongle()
@@ -0,0 +1,40 @@
+""" Module for STN11xx/STN2xxx based dongles (OBDLink) """
+from math import ceil
+from .elm327 import Elm327, ST_STEP
+
+
+class Stn11xx(Elm327):
+    """ Implementation for STN chips, ELM327 compatible with an extended
+        command set. Requests are sent with STPX, which carries header,
+        response count and timeout, so switching ECUs does not need
+        ATSH and ATST commands. """
+
+    # STBR sets the speed directly, the chips run up to 10 Mbps
+    Speeds = (38400, 57600, 115200, 230400, 500000, 1000000, 2000000)
+    # STPX takes the response count as decimal number and the chips
+    # buffer far more frames than the ELM327
+    MaxCountHint = 0xff
+
+    def init_dongle(self):
+        """ Initialize like an ELM327 and make sure it is a STN """
+        Elm327.init_dongle(self)
+        self.send_at_cmd('STI', 'STN')
+
+    def speed_command(self, speed):
+        """ Return the command switching the serial speed """
+        return 'STBR%d' % speed
+
+    def format_request(self, cmd, cantx, hint):
+        """ Return the STPX command for the hex string cmd to cantx with
+            the learned timeout of the ECU and number of frames """
+        can_id = format(cantx, '08X' if self._is_extended else '03X')
+        timeout = ceil(self.learned_st(cantx) * ST_STEP * 1000)
+        if hint is None:
+            return 'STPX h:%s, d:%s, t:%d' % (can_id, cmd, timeout)
+        return 'STPX h:%s, d:%s, r:%d, t:%d' % (can_id, cmd, hint, timeout)
+
+    def prepare_request(self, cantx):
+        """ The timeout is part of the STPX command """
+
+    def set_can_id(self, can_id):
+        """ The header is part of the STPX command """
@@ -0,0 +1,147 @@
+""" Tests for the polling logic of IsoTpDecoder """
+from copy import deepcopy
+from dongle import NoData
+from dongle.socket_can import SocketCan
+from car import zoe_ze50
+from car.isotp_decoder import IsoTpDecoder
+
+
+class EcuDongle:
+    """ Answers requests from a table, requests in failing get no data """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.failing = set()
+        self.sent = []
+
+    def send_command_ex(self, cmd, cantx, canrx):
+        """ Return the response to cmd or raise NoData """
+        self.sent.append((cmd, cantx))
+        if (cmd, cantx) in self.failing:
+            raise NoData('NO DATA')
+        return self.responses[(cmd, cantx)]
+
+
+def make_fields():
+    """ A mandatory and an optional group, both polled every cycle """
+    return [
+        {'cmd': bytes.fromhex('220101'), 'canrx': 0x7ec, 'cantx': 0x7e4,
+         'fields': (
+             {'padding': 3},
+             {'name': 'SOC_BMS', 'width': 1, 'scale': .5},
+         )
+         },
+        {'cmd': bytes.fromhex('22b002'), 'canrx': 0x7ce, 'cantx': 0x7c6, 'optional': True,
+         'fields': (
+             {'padding': 3},
+             {'name': 'odo', 'width': 3},
+         )
+         },
+    ]
+
+
+def test_optional_values_carried_forward():
+    dongle = EcuDongle({
+        (bytes.fromhex('220101'), 0x7e4): bytes.fromhex('62010196'),
+        (bytes.fromhex('22b002'), 0x7c6): bytes.fromhex('62b002012345'),
+    })
+    decoder = IsoTpDecoder(dongle, make_fields())
+
+    data = decoder.get_data()
+    assert data['odo'] == 0x12345
+
+    # Fails once, then backs off and is not requested
+    dongle.failing.add((bytes.fromhex('22b002'), 0x7c6))
+    for _ in range(2):
+        dongle.sent.clear()
+        data = decoder.get_data()
+        assert data['SOC_BMS'] == 75
+        assert data['odo'] == 0x12345
+        assert '%x:%s' % (0x7c6, '22b002') in data['optionalBackoff']
+    assert dongle.sent == [(bytes.fromhex('220101'), 0x7e4)]
+
+
+class BcmSocketCan(SocketCan):
+    """ SocketCan without link and sockets, records the setup of jobs
+        and answers direct requests from a table """
+
+    def __init__(self, config):
+        self.armed = []
+        self.direct = {}
+        SocketCan.__init__(self, config)
+
+    def init_dongle(self):
+        """ Nothing to set up """
+
+    def _setup_bcm(self):
+        """ All jobs run """
+        self._bcm_armed.update(self._bcm_jobs)
+
+    def _bcm_arm(self, ecu):
+        self.armed.append(ecu)
+        self._bcm_armed.add(ecu)
+
+    def _bcm_disarm(self, ecu):
+        self._bcm_armed.discard(ecu)
+
+    def _send_command_ex_direct(self, cmd, cantx, canrx):
+        if cmd not in self.direct:
+            raise NoData('NO DATA')
+        return self.direct[cmd]
+
+
+def test_zoe_ze50_requests_on_bcm():
+    dongle = BcmSocketCan({'port': 'can0', 'speed': 500000, 'bcm': True})
+    decoder = IsoTpDecoder(dongle, deepcopy(zoe_ze50.Fields),
+                           multi_did=(zoe_ze50.LBC_TX, zoe_ze50.EVC_TX, zoe_ze50.BCB_TX))
+
+    # pylint: disable=protected-access
+    registered = {cmd_data['cmd'].hex() for cmd_data in decoder._fields
+                  if not cmd_data['computed'] and not cmd_data['batchable']}
+    assert registered == {'222005', '225017', '229002', '229001', '229006',
+                          '229245', '222006', '229257'}
+
+    jobs = dongle._bcm_jobs
+    assert jobs[(zoe_ze50.LBC_TX, zoe_ze50.LBC_RX)]['tx'] == {
+        1: tuple(bytes.fromhex(cmd) for cmd in ('229002', '229001', '229006', '229257')),
+        60: (bytes.fromhex('229245'),)}
+    assert jobs[(zoe_ze50.EVC_TX, zoe_ze50.EVC_RX)]['tx'] == {
+        10: (bytes.fromhex('222005'),),
+        60: (bytes.fromhex('222006'),)}
+    assert jobs[(zoe_ze50.BCB_TX, zoe_ze50.BCB_RX)]['tx'] == {
+        1: (bytes.fromhex('225017'),)}
+
+
+def test_bcm_rearmed_once():
+    dongle = BcmSocketCan({'port': 'can0', 'speed': 500000, 'bcm': True})
+    cmd = bytes.fromhex('225017')
+    ecu = (zoe_ze50.BCB_TX, zoe_ze50.BCB_RX)
+    dongle.register_cyclic([{'cmd': cmd, 'cantx': ecu[0], 'canrx': ecu[1], 'interval': 0}])
+
+    # pylint: disable=protected-access
+    # The ECU stopped answering: sent directly, the jobs stay deleted
+    dongle._bcm_disarm(ecu)
+    for _ in range(3):
+        try:
+            dongle.send_command_ex_bcm(cmd, ecu[0], ecu[1])
+        except NoData:
+            pass
+    assert not dongle.armed
+
+    # It answers again, its jobs are set up once
+    dongle.direct[cmd] = bytes.fromhex('62501701')
+    assert dongle.send_command_ex_bcm(cmd, ecu[0], ecu[1]) == dongle.direct[cmd]
+    dongle._bcm_responses[(ecu[1], cmd)] = dongle.direct[cmd]
+    assert dongle.send_command_ex_bcm(cmd, ecu[0], ecu[1]) == dongle.direct[cmd]
+    assert dongle.armed == [ecu]
+
+    # Polling suspended and resumed, set up once with the first request
+    dongle._bcm_sock = object()
+    dongle.suspend_cyclic()
+    dongle._bcm_cmds[(ecu[1], cmd)] = 0
+    for _ in range(3):
+        try:
+            dongle.send_command_ex_bcm(cmd, ecu[0], ecu[1])
+        except NoData:
+            pass
+    assert dongle.armed == [ecu, ecu]